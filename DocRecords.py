@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+"""
+Compact records for the site, priority and work documents derived from
+each agent report. They keep their fields in __slots__ instead of a
+per-document dict, share repeated strings, and only become dicts (or
+JSON) at the sinks, through to_dict.
+"""
+
+_shared = {} # string -> the one instance of it used by all records
+def share(value):
+    """Return the shared instance of a repeated string (site, status, ...)"""
+    return _shared.setdefault(value, value)
+
+def to_dict(obj):
+    """json `default` hook: serialize records as dicts"""
+    if isinstance(obj, DocRecord):
+        return obj.to_dict()
+    raise TypeError('%r is not JSON serializable' % (obj,))
+
+
+class DocRecord(object):
+    """
+    Base class of the records. Supports the read-only mapping access
+    the pipeline uses on docs: doc[key], get, keys and iteritems,
+    including the per-class constant 'type'.
+    """
+    __slots__ = ()
+    type = None
+    shared_fields = () # repeated strings, shared again by fromtuple
+
+    def __getitem__(self, key):
+        if key == 'type':
+            return self.type
+        if key in self.__slots__:
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        return key == 'type' or key in self.__slots__
+
+    def keys(self):
+        return ['type'] + list(self.__slots__)
+
+    def iteritems(self):
+        yield 'type', self.type
+        for field in self.__slots__:
+            yield field, getattr(self, field)
+
+    def to_dict(self):
+        return dict(self.iteritems())
+
+    def astuple(self):
+        """The field values, e.g. to marshal the record"""
+        return tuple(getattr(self, field) for field in self.__slots__)
+
+    @classmethod
+    def fromtuple(cls, values):
+        """The record of `astuple` values, e.g. unmarshalled ones"""
+        record = cls(*values)
+        for field in cls.shared_fields:
+            setattr(record, field, share(getattr(record, field)))
+        return record
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.astuple() == other.astuple()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
+
+class SiteInfo(DocRecord):
+    __slots__ = ('site_name', 'agent_url', 'timestamp', 'state',
+                 'thresholds', 'thresholdsGQ2LQ', 'LocalWQ_INFO')
+    type = 'site_info'
+    shared_fields = ('site_name', 'agent_url', 'state')
+
+    def __init__(self, site_name, agent_url, timestamp, state,
+                 thresholds, thresholdsGQ2LQ, LocalWQ_INFO):
+        self.site_name = site_name
+        self.agent_url = agent_url
+        self.timestamp = timestamp
+        self.state = state
+        self.thresholds = thresholds
+        self.thresholdsGQ2LQ = thresholdsGQ2LQ
+        self.LocalWQ_INFO = LocalWQ_INFO
+
+
+class PriorityInfo(DocRecord):
+    __slots__ = ('site_name', 'agent_url', 'timestamp', 'priority', 'count')
+    type = 'priority_info'
+    shared_fields = ('site_name', 'agent_url', 'priority')
+
+    def __init__(self, site_name, agent_url, timestamp, priority, count):
+        self.site_name = site_name
+        self.agent_url = agent_url
+        self.timestamp = timestamp
+        self.priority = priority
+        self.count = count
+
+
+class WorkInfo(DocRecord):
+    __slots__ = ('agent_url', 'timestamp', 'status', 'count', 'sum')
+    type = 'work_info'
+    shared_fields = ('agent_url', 'status')
+
+    def __init__(self, agent_url, timestamp, status, count, sum):
+        self.agent_url = agent_url
+        self.timestamp = timestamp
+        self.status = status
+        self.count = count
+        self.sum = sum
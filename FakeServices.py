@@ -0,0 +1,357 @@
+#!/usr/bin/env python
+"""
+Minimal in-process stand-ins for the CERN AMQ STOMP broker and for
+Elasticsearch, with configurable latency and failure injection, to
+measure and test StompAMQ and WMAMonElasticInterface without the
+real services
+"""
+import json
+import time
+import random
+import fnmatch
+import logging
+import threading
+import SocketServer
+import BaseHTTPServer
+
+def percentile(values, fraction):
+    """Simple nearest-rank percentile of a list of numbers"""
+    if not values:
+        return 0.
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+class _ThreadingTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _StompHandler(SocketServer.BaseRequestHandler):
+    """Speaks just enough STOMP 1.x: CONNECT/STOMP, SEND, DISCONNECT and receipts"""
+
+    def handle(self):
+        broker = self.server.broker
+        self.buf = ''
+        while True:
+            frame = self.read_frame()
+            if frame is None:
+                return
+            command, headers, body = frame
+
+            if command in ('CONNECT', 'STOMP'):
+                if broker.roll(broker.connect_failure_rate):
+                    self.send_frame('ERROR', {'message': 'injected connect failure'})
+                    return
+                broker.count('connects')
+                self.send_frame('CONNECTED', {'version': '1.1', 'heart-beat': '0,0'})
+                continue
+
+            if command == 'SEND':
+                if broker.latency:
+                    time.sleep(broker.latency)
+                if broker.roll(broker.failure_rate):
+                    broker.count('failures')
+                    error_headers = {'message': 'injected failure'}
+                    if 'receipt' in headers:
+                        error_headers['receipt-id'] = headers['receipt']
+                    self.send_frame('ERROR', error_headers)
+                    continue
+                broker.record(headers, body)
+
+            if 'receipt' in headers:
+                self.send_frame('RECEIPT', {'receipt-id': headers['receipt']})
+
+            if command == 'DISCONNECT':
+                return
+
+    def read_frame(self):
+        """Read one frame, skipping heart-beats. Returns None on EOF"""
+        while True:
+            self.buf = self.buf.lstrip('\r\n')
+            head_end = self.buf.find('\n\n')
+            if head_end >= 0:
+                lines = self.buf[:head_end].replace('\r', '').split('\n')
+                headers = dict(line.split(':', 1) for line in lines[1:] if ':' in line)
+                if 'content-length' in headers:
+                    body_end = head_end + 2 + int(headers['content-length'])
+                else:
+                    body_end = self.buf.find('\0', head_end)
+                if body_end >= 0 and len(self.buf) > body_end:
+                    body = self.buf[head_end+2:body_end]
+                    self.buf = self.buf[body_end+1:]
+                    return lines[0], headers, body
+            data = self.request.recv(65536)
+            if not data:
+                return None
+            self.buf += data
+
+    def send_frame(self, command, headers, body=''):
+        head = '\n'.join('%s:%s' % item for item in headers.items())
+        self.request.sendall('%s\n%s\n\n%s\0' % (command, head, body))
+
+
+class FakeStompBroker(object):
+    """
+    STOMP broker accepting CONNECT/SEND/DISCONNECT and answering
+    receipts, on 127.0.0.1 and a free port.
+
+    :param latency: Seconds to wait before handling each SEND frame
+    :param failure_rate: Fraction of SEND frames answered with an ERROR
+    :param connect_failure_rate: Fraction of refused connections
+    :param keep_messages: Keep the received (headers, body) pairs
+    """
+    def __init__(self, latency=0., failure_rate=0., connect_failure_rate=0.,
+                 keep_messages=False, seed=None):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.connect_failure_rate = connect_failure_rate
+        self.keep_messages = keep_messages
+        self.messages = []
+        self.stats = {'connects': 0, 'frames': 0, 'docs': 0, 'bytes': 0, 'failures': 0}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = None
+
+    def roll(self, rate):
+        with self._lock:
+            return rate > 0 and self._random.random() < rate
+
+    def count(self, key, value=1):
+        with self._lock:
+            self.stats[key] += value
+
+    def record(self, headers, body):
+        # Frames packed by StompAMQ with batch_size > 1 hold a JSON array
+        n_docs = len(json.loads(body)) if body.startswith('[') else 1
+        with self._lock:
+            self.stats['frames'] += 1
+            self.stats['docs'] += n_docs
+            self.stats['bytes'] += len(body)
+            if self.keep_messages:
+                self.messages.append((headers, body))
+
+    def start(self):
+        self._server = _ThreadingTCPServer(('127.0.0.1', 0), _StompHandler)
+        self._server.broker = self
+        thread = threading.Thread(target=self._server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    @property
+    def host_and_port(self):
+        return '127.0.0.1:%d' % self.port
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+class _ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _ElasticHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Handles ping, index creation/deletion, templates, _bulk, _search and _msearch"""
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        logging.getLogger(__name__).debug(format, *args)
+
+    def handle_request(self):
+        es = self.server.elastic
+        start = time.time()
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else ''
+        path = self.path.split('?', 1)[0].strip('/')
+        parts = path.split('/') if path else []
+
+        if es.latency:
+            time.sleep(es.latency)
+
+        if es.roll(es.failure_rate):
+            status, response = 503, {'error': 'injected failure', 'status': 503}
+        elif not parts:
+            status, response = 200, {'name': 'fake', 'version': {'number': '5.6.0'}}
+        elif parts[-1] == '_bulk':
+            status, response = 200, es.bulk(body)
+        elif parts[-1] == '_msearch':
+            lines = [json.loads(line) for line in body.splitlines() if line.strip()]
+            responses = [es.search(header.get('index'), query)
+                         for header, query in zip(lines[::2], lines[1::2])]
+            status, response = 200, {'responses': responses}
+        elif parts[-1] == '_search':
+            status, response = 200, es.search(parts[0], json.loads(body) if body else {})
+        elif parts[0] == '_template':
+            status, response = es.put_template(parts[1], body, self.command)
+        elif parts[-1] in ('_alias', '_aliases'):
+            pattern = parts[0] if len(parts) > 1 else '*'
+            status, response = 200, dict((name, {'aliases': {}}) for name in es.indices()
+                                         if fnmatch.fnmatch(name, pattern))
+        elif self.command == 'PUT':
+            status, response = es.create_index(parts[0])
+        elif self.command == 'DELETE':
+            status, response = es.delete_index(parts[0])
+        elif self.command in ('HEAD', 'GET') and len(parts) == 1:
+            status, response = (200 if parts[0] in es.docs else 404), {}
+        else:
+            status, response = 400, {'error': 'unsupported request %s %s' % (self.command, self.path)}
+
+        payload = json.dumps(response) if self.command != 'HEAD' else ''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+        es.record_latency(parts[-1] if parts else '/', time.time() - start)
+
+    do_GET = do_HEAD = do_PUT = do_POST = do_DELETE = handle_request
+
+
+class FakeElasticsearch(object):
+    """
+    In-memory Elasticsearch HTTP endpoint on 127.0.0.1 and a free port.
+
+    :param latency: Seconds to wait before answering each request
+    :param failure_rate: Fraction of requests failing with 503
+    :param reject_rate: Fraction of bulk items rejected with 429
+    """
+    def __init__(self, latency=0., failure_rate=0., reject_rate=0., seed=None):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.reject_rate = reject_rate
+        self.docs = {} # index -> {id: source}
+        self.templates = {}
+        self.latencies = {} # endpoint -> [seconds]
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._next_id = 0
+        self._server = None
+
+    def roll(self, rate):
+        with self._lock:
+            return rate > 0 and self._random.random() < rate
+
+    def record_latency(self, endpoint, seconds):
+        with self._lock:
+            self.latencies.setdefault(endpoint, []).append(seconds)
+
+    def indices(self):
+        with self._lock:
+            return sorted(self.docs)
+
+    def n_docs(self):
+        with self._lock:
+            return sum(len(docs) for docs in self.docs.values())
+
+    def create_index(self, name):
+        with self._lock:
+            if name in self.docs:
+                return 400, {'error': {'root_cause': [{'type': 'index_already_exists_exception',
+                                                       'reason': 'already exists'}]},
+                             'status': 400}
+            self.docs[name] = {}
+        return 200, {'acknowledged': True}
+
+    def delete_index(self, name):
+        with self._lock:
+            if self.docs.pop(name, None) is None:
+                return 404, {'status': 404}
+        return 200, {'acknowledged': True}
+
+    def put_template(self, name, body, command):
+        with self._lock:
+            if command == 'PUT':
+                self.templates[name] = json.loads(body) if body else {}
+                return 200, {'acknowledged': True}
+            if name in self.templates:
+                return 200, {name: self.templates[name]}
+        return 404, {}
+
+    def bulk(self, body):
+        lines = [line for line in body.splitlines() if line.strip()]
+        items = []
+        errors = False
+        pos = 0
+        while pos < len(lines):
+            action = json.loads(lines[pos])
+            op_type, meta = action.items()[0]
+            source = None
+            if op_type != 'delete':
+                pos += 1
+                source = json.loads(lines[pos])
+            pos += 1
+
+            index = meta.get('_index')
+            with self._lock:
+                docs = self.docs.setdefault(index, {})
+                doc_id = meta.get('_id')
+                if doc_id is None:
+                    self._next_id += 1
+                    doc_id = 'auto%d' % self._next_id
+                if self.reject_rate and self._random.random() < self.reject_rate:
+                    status = 429
+                elif op_type == 'create' and doc_id in docs:
+                    status = 409
+                elif op_type == 'delete':
+                    status = 200 if docs.pop(doc_id, None) is not None else 404
+                else:
+                    status = 200 if doc_id in docs else 201
+                    docs[doc_id] = source
+
+            item = {'_index': index, '_type': meta.get('_type'), '_id': doc_id, 'status': status}
+            if status >= 400:
+                errors = True
+                item['error'] = {'type': {409: 'version_conflict_engine_exception',
+                                          429: 'es_rejected_execution_exception',
+                                          404: 'not_found'}.get(status, 'error'),
+                                 'reason': 'injected' if status == 429 else 'fake'}
+            items.append({op_type: item})
+        return {'took': 1, 'errors': errors, 'items': items}
+
+    def search(self, index, query):
+        """Supports the bool/must/match queries used by WMAMonElasticInterface"""
+        try:
+            matches = [clause['match'] for clause in query['query']['bool']['must']]
+        except (KeyError, TypeError):
+            matches = []
+        with self._lock:
+            docs = [doc for name, idx_docs in self.docs.items()
+                    if index in (None, '_all', name)
+                    for doc in idx_docs.values()]
+        hits = [doc for doc in docs
+                if all(str(doc.get(field)) == str(value)
+                       for match in matches for field, value in match.items())]
+        size = query.get('size', 10)
+        return {'took': 1, 'timed_out': False,
+                'hits': {'total': len(hits), 'hits': [{'_source': doc} for doc in hits[:size]]}}
+
+    def start(self):
+        self._server = _ThreadingHTTPServer(('127.0.0.1', 0), _ElasticHandler)
+        self._server.elastic = self
+        thread = threading.Thread(target=self._server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    @property
+    def host_and_port(self):
+        return '127.0.0.1:%d' % self.port
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
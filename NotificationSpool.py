@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+"""
+Bounded on-disk spool of notifications that could not be sent,
+kept as gzip-compressed NDJSON segments and drained oldest first
+"""
+import os
+import gzip
+import json
+import time
+import logging
+import tempfile
+import threading
+
+from DocRecords import to_dict
+
+class NotificationSpool(object):
+    """
+    Each `write` adds one or more segment files named after the time
+    they were written, so that sorting the names gives the sending order.
+
+    :param directory: Where to keep the segments
+    :param max_bytes: Maximum total compressed size; the oldest
+        segments are dropped beyond it
+    :param max_age: Segments older than this many seconds are dropped
+    :param segment_docs: Maximum number of notifications per segment
+    """
+    def __init__(self, directory, max_bytes=100*1024*1024, max_age=24*3600, segment_docs=10000):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.segment_docs = segment_docs
+        self._lock = threading.Lock()
+        self._seq = 0
+        self._logger = logging.getLogger(__name__)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def segments(self):
+        """Paths of the segments, oldest first"""
+        return [os.path.join(self.directory, name) for name in sorted(os.listdir(self.directory))
+                if name.startswith('spool-') and name.endswith('.ndjson.gz')]
+
+    def _new_path(self):
+        with self._lock:
+            self._seq += 1
+            return os.path.join(self.directory, 'spool-%017.6f-%06d-%d.ndjson.gz' % (
+                time.time(), self._seq % 1000000, os.getpid()))
+
+    @staticmethod
+    def _segment_time(path):
+        """When a segment was first written, kept in its name across rewrites"""
+        return float(os.path.basename(path).split('-')[1])
+
+    def _write_segment(self, path, notifications):
+        tmp = tempfile.NamedTemporaryFile('wb', dir=self.directory, delete=False, prefix='.tmp-')
+        try:
+            with gzip.GzipFile(fileobj=tmp, mode='wb') as zfile:
+                for notification in notifications:
+                    zfile.write(json.dumps(notification, default=to_dict))
+                    zfile.write('\n')
+            tmp.flush()
+            os.fsync(tmp.fileno())
+            tmp.close()
+            os.rename(tmp.name, path)
+        except Exception:
+            tmp.close()
+            os.remove(tmp.name)
+            raise
+
+    def write(self, notifications):
+        """
+        Spool an iterable of notifications as new segments
+
+        :return: the number of notifications spooled
+        """
+        count = 0
+        segment = []
+        for notification in notifications:
+            segment.append(notification)
+            if len(segment) >= self.segment_docs:
+                self._write_segment(self._new_path(), segment)
+                count += len(segment)
+                segment = []
+        if segment:
+            self._write_segment(self._new_path(), segment)
+            count += len(segment)
+        if count:
+            self._logger.warning("Spooled %d unsent notifications to %s", count, self.directory)
+            self.enforce_limits()
+        return count
+
+    def read(self, path):
+        with gzip.open(path, 'rb') as zfile:
+            return [json.loads(line) for line in zfile if line.strip()]
+
+    def enforce_limits(self):
+        """Drop segments older than max_age, then the oldest beyond max_bytes"""
+        now = time.time()
+        sizes = []
+        for path in self.segments():
+            try:
+                if self.max_age and now - self._segment_time(path) > self.max_age:
+                    os.remove(path)
+                    self._logger.error("Dropped spool segment %s, older than %d s", path, self.max_age)
+                    continue
+                sizes.append((path, os.path.getsize(path)))
+            except OSError: # Drained concurrently
+                continue
+        total = sum(size for _, size in sizes)
+        for path, size in sizes:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+            self._logger.error("Dropped spool segment %s, spool above %d bytes", path, self.max_bytes)
+
+    def drain(self, send):
+        """
+        Send the spooled notifications, oldest segment first, with
+        `send(notifications)` returning the bodies that were sent.
+        Stops at the first segment that is not fully sent, keeping
+        its unsent notifications for the next drain.
+
+        :return: the number of notifications sent
+        """
+        self.enforce_limits()
+        n_sent = 0
+        for path in self.segments():
+            try:
+                notifications = self.read(path)
+            except (IOError, ValueError, EOFError) as exc:
+                self._logger.error("Dropping unreadable spool segment %s: %s", path, str(exc))
+                os.remove(path)
+                continue
+
+            sent_ids = set(id(body) for body in send(notifications))
+            unsent = [n for n in notifications if id(n['body']) not in sent_ids]
+            n_sent += len(notifications) - len(unsent)
+            if unsent:
+                self._write_segment(path, unsent)
+                self._logger.warning("%d spooled notifications still unsent, stopping the drain", len(unsent))
+                break
+            os.remove(path)
+
+        if n_sent:
+            self._logger.warning("Sent %d spooled notifications from %s", n_sent, self.directory)
+        return n_sent
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+"""
+Adaptive token-bucket rate limiter for the broker submissions: a
+msgs/sec and bytes/sec ceiling, scaled down when the broker looks
+unhealthy and recovering to the full ceiling once it looks fine again
+"""
+import time
+import logging
+import threading
+from collections import Counter
+
+class AdaptiveRateLimiter(object):
+    """
+    Two token buckets (messages and bytes) refilled at `factor` times
+    their ceiling. Senders call `acquire` before each frame and sleep
+    until both buckets cover it; a frame may overdraw the buckets, so
+    concurrent senders queue up behind the debt instead of bursting.
+
+    The factor is decreased multiplicatively by `penalize` (broker
+    errors, heartbeat timeouts, dropped connections, failed sends) and
+    by `observe_latency` when the average send latency goes above
+    `target_latency`. It grows back linearly, by `recovery` per second,
+    while the latency is below target.
+
+    :param msgs_per_sec: Ceiling in messages per second (0: no limit)
+    :param bytes_per_sec: Ceiling in body bytes per second (0: no limit)
+    :param burst: Bucket sizes, in seconds worth of the ceiling
+    :param target_latency: Average send latency, in seconds, above
+        which the rate is decreased
+    :param decrease: Factor applied to the rate on each penalty
+    :param recovery: Fraction of the ceiling regained per second
+    :param min_factor: Lowest fraction of the ceiling to go down to
+    :param cooldown: Minimum seconds between two penalties, so that a
+        burst of errors from one incident counts once
+    """
+    def __init__(self, msgs_per_sec=0, bytes_per_sec=0, burst=1.,
+                 target_latency=0.5, decrease=0.7, recovery=0.1,
+                 min_factor=0.05, cooldown=2.):
+        self.msgs_per_sec = float(msgs_per_sec)
+        self.bytes_per_sec = float(bytes_per_sec)
+        self.burst = burst
+        self.target_latency = target_latency
+        self.decrease = decrease
+        self.recovery = recovery
+        self.min_factor = min_factor
+        self.cooldown = cooldown
+
+        self.factor = 1.
+        self.latency = 0. # moving average of the observed latencies
+        self.waited = 0. # total seconds spent waiting in acquire
+        self.penalties = Counter() # per reason
+        self._msgs = self.msgs_per_sec * burst
+        self._bytes = self.bytes_per_sec * burst
+        self._updated = time.time()
+        self._penalized = 0.
+        self._lock = threading.Lock()
+        self._logger = logging.getLogger(__name__)
+
+    def _update(self, now):
+        """Regain part of the ceiling and refill the buckets up to `now`"""
+        elapsed = max(0., now - self._updated)
+        self._updated = now
+        if self.factor < 1. and self.latency <= self.target_latency:
+            self.factor = min(1., self.factor + self.recovery * elapsed)
+        self._msgs = min(self.msgs_per_sec * self.burst,
+                         self._msgs + elapsed * self.msgs_per_sec * self.factor)
+        self._bytes = min(self.bytes_per_sec * self.burst,
+                          self._bytes + elapsed * self.bytes_per_sec * self.factor)
+
+    def acquire(self, n_bytes=0):
+        """
+        Take one message and `n_bytes` from the buckets, sleeping until
+        they are available
+
+        :return: the seconds waited
+        """
+        with self._lock:
+            self._update(time.time())
+            wait = 0.
+            if self.msgs_per_sec:
+                self._msgs -= 1
+                wait = max(wait, -self._msgs / (self.msgs_per_sec * self.factor))
+            if self.bytes_per_sec:
+                self._bytes -= n_bytes
+                wait = max(wait, -self._bytes / (self.bytes_per_sec * self.factor))
+            self.waited += wait
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def penalize(self, reason):
+        """
+        Decrease the rate after a sign of trouble with the broker, and
+        drop whatever burst is left in the buckets
+
+        :return: True if the rate was decreased, False within the cooldown
+        """
+        with self._lock:
+            self.penalties[reason] += 1
+            now = time.time()
+            self._update(now)
+            if now - self._penalized < self.cooldown:
+                return False
+            self._penalized = now
+            self.factor = max(self.min_factor, self.factor * self.decrease)
+            self._msgs = min(self._msgs, 0.)
+            self._bytes = min(self._bytes, 0.)
+            factor = self.factor
+        self._logger.warning("Broker %s, lowering the send rate to %d%% of the ceiling",
+                             reason, round(factor * 100))
+        return True
+
+    def observe_latency(self, seconds):
+        """Account the latency of one send or receipt"""
+        with self._lock:
+            self.latency = 0.8 * self.latency + 0.2 * seconds
+            slow = self.latency > self.target_latency
+        if slow:
+            self.penalize('slow')
+
+    def stats(self):
+        with self._lock:
+            return {'factor': self.factor, 'latency': self.latency,
+                    'waited': self.waited, 'penalties': dict(self.penalties)}
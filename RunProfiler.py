@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+"""
+CPU (cProfile) and allocation (tracemalloc) profiling of a single
+post_agentinfo run, written out as pstats and plain text reports
+"""
+import os
+import time
+import pstats
+import cProfile
+import logging
+import threading
+from StringIO import StringIO
+
+try:
+    import tracemalloc
+except ImportError: # Python 2
+    tracemalloc = None
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Functions shown in their own section of the CPU report
+FOCUS = 'process_site_information|site_information_from_row|process_rows|send'
+
+class RunProfiler(object):
+    """
+    Profile one run. The calling thread is profiled between `start` and
+    `stop`; functions run on other threads are profiled if they are
+    wrapped with `wrap`. All profiles are merged into one report.
+
+    :param directory: Where to write the reports
+    :param top: Number of functions and allocation sites to list
+    """
+    def __init__(self, directory, top=40):
+        self.directory = directory
+        self.top = top
+        self._profiles = []
+        self._lock = threading.Lock()
+        self._logger = logging.getLogger(__name__)
+
+    def _new_profile(self):
+        profile = cProfile.Profile()
+        with self._lock:
+            self._profiles.append(profile)
+        return profile
+
+    def start(self):
+        self._started = time.time()
+        if tracemalloc is not None:
+            tracemalloc.start()
+        self._main = self._new_profile()
+        self._main.enable()
+        return self
+
+    def wrap(self, func):
+        """Return `func` profiled in whatever thread it runs in"""
+        def profiled(*args, **kwargs):
+            return self._new_profile().runcall(func, *args, **kwargs)
+        return profiled
+
+    def stop(self):
+        """
+        Stop profiling and write <prefix>.pstats, <prefix>.txt with the
+        top functions and <prefix>.alloc.txt with the top allocation sites
+
+        :return: the common prefix of the report files
+        """
+        self._main.disable()
+        snapshot = None
+        if tracemalloc is not None:
+            snapshot = tracemalloc.take_snapshot()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        prefix = os.path.join(self.directory, time.strftime('profile_%Y%m%d-%H%M%S',
+                                                            time.localtime(self._started)))
+
+        with self._lock:
+            profiles = list(self._profiles)
+        stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            stats.add(profile)
+        stats.dump_stats(prefix + '.pstats')
+
+        report = StringIO()
+        stats.stream = report
+        report.write('Run of %.3f s, %d profiled threads\n\n' % (time.time() - self._started, len(profiles)))
+        stats.sort_stats('cumulative').print_stats(self.top)
+        stats.sort_stats('tottime').print_stats(self.top)
+        stats.sort_stats('cumulative').print_stats(FOCUS)
+        with open(prefix + '.txt', 'w') as ofile:
+            ofile.write(report.getvalue())
+
+        with open(prefix + '.alloc.txt', 'w') as ofile:
+            if snapshot is not None:
+                snapshot = snapshot.filter_traces([
+                    tracemalloc.Filter(False, tracemalloc.__file__),
+                    tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+                ])
+                ofile.write('Peak traced memory: %d kB\n\n' % (peak // 1024))
+                for stat in snapshot.statistics('lineno')[:self.top]:
+                    ofile.write('%s\n' % stat)
+            else:
+                ofile.write('tracemalloc is not available in this Python, no allocation sites\n')
+                if resource is not None:
+                    ofile.write('Process max RSS: %d kB\n' % resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+        self._logger.warning("Profile of this run written to %s.*", prefix)
+        return prefix
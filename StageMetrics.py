@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+"""
+Per-stage timing and throughput counters for the post_agentinfo
+pipeline, written out as JSON or as a Prometheus textfile
+"""
+import os
+import json
+import time
+import tempfile
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+class MeteredReader(object):
+    """
+    File-like wrapper adding the time spent in read() and the bytes
+    read to a stage of `metrics`
+    """
+    def __init__(self, stream, metrics, stage):
+        self._stream = stream
+        self._metrics = metrics
+        self._stage = stage
+
+    def read(self, *args):
+        start = time.time()
+        data = self._stream.read(*args)
+        self._metrics.add(self._stage, seconds=time.time() - start, bytes_=len(data))
+        return data
+
+
+class StageMetrics(object):
+    """
+    Thread-safe accumulator of seconds, documents, bytes and calls per
+    named stage, in the order the stages were first seen
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._stages = OrderedDict()
+            self.started = time.time()
+
+    def add(self, stage, seconds=0., docs=0, bytes_=0):
+        with self._lock:
+            counts = self._stages.get(stage)
+            if counts is None:
+                counts = self._stages[stage] = {'seconds': 0., 'docs': 0, 'bytes': 0, 'calls': 0}
+            counts['seconds'] += seconds
+            counts['docs'] += docs
+            counts['bytes'] += bytes_
+            counts['calls'] += 1
+
+    @contextmanager
+    def timed(self, stage, docs=0, bytes_=0):
+        """Add the time spent in the with block to `stage`"""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(stage, seconds=time.time() - start, docs=docs, bytes_=bytes_)
+
+    def seconds(self, *stages):
+        """Total seconds recorded so far for `stages`"""
+        with self._lock:
+            return sum(self._stages[s]['seconds'] for s in stages if s in self._stages)
+
+    def reader(self, stream, stage):
+        return MeteredReader(stream, self, stage)
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                'timestamp': int(self.started),
+                'total_seconds': time.time() - self.started,
+                'stages': OrderedDict((name, dict(counts)) for name, counts in self._stages.items()),
+            }
+
+    def to_prometheus(self, prefix='wmamon_agentinfo'):
+        """Prometheus text exposition format, one gauge family per counter"""
+        summary = self.as_dict()
+        lines = []
+        for key, help_ in [('seconds', 'Seconds spent in the stage'),
+                           ('docs', 'Documents handled by the stage'),
+                           ('bytes', 'Bytes handled by the stage'),
+                           ('calls', 'Number of times the stage ran')]:
+            metric = '%s_stage_%s' % (prefix, key)
+            lines.append('# HELP %s %s' % (metric, help_))
+            lines.append('# TYPE %s gauge' % metric)
+            for name, counts in summary['stages'].items():
+                lines.append('%s{stage="%s"} %r' % (metric, name.replace('"', '\\"'), counts[key]))
+        lines.append('# HELP %s_last_run_timestamp_seconds Start of the last run' % prefix)
+        lines.append('# TYPE %s_last_run_timestamp_seconds gauge' % prefix)
+        lines.append('%s_last_run_timestamp_seconds %d' % (prefix, summary['timestamp']))
+        lines.append('# HELP %s_run_seconds Duration of the last run' % prefix)
+        lines.append('# TYPE %s_run_seconds gauge' % prefix)
+        lines.append('%s_run_seconds %r' % (prefix, summary['total_seconds']))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, filename, fmt='json'):
+        """
+        Write the metrics atomically to `filename`, as JSON or ('prometheus')
+        in the node_exporter textfile format
+        """
+        if fmt == 'prometheus':
+            text = self.to_prometheus()
+        else:
+            text = json.dumps(self.as_dict(), indent=2)
+        dirname = os.path.dirname(os.path.abspath(filename))
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        tmp = tempfile.NamedTemporaryFile('w', dir=dirname, delete=False,
+                                          prefix=os.path.basename(filename) + '.')
+        try:
+            tmp.write(text)
+            tmp.close()
+            os.rename(tmp.name, filename)
+        except Exception:
+            tmp.close()
+            os.remove(tmp.name)
+            raise
@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+"""
+Persistent key/value state for post_agentinfo (last processed timestamps,
+delta cache, ...), organised in namespaces with pluggable backends
+"""
+import os
+import json
+import fcntl
+import logging
+import sqlite3
+import tempfile
+import threading
+
+class JSONStateStore(object):
+    """
+    Keeps each namespace in its own JSON file. Updates are appended
+    to a log next to it (`<file>.log`, one JSON object of changes per
+    line), so their cost is proportional to the number of changed keys.
+    Once the log outgrows the file, both are compacted into a new file,
+    written atomically (temporary file, then rename). Appends and
+    compactions hold a lock on the log, so that several processes can
+    share the store.
+
+    :param filename: File for the 'timestamps' namespace, the other
+        namespaces go to `filename.<namespace>`
+    :param min_compact_bytes: Don't compact logs smaller than this
+    """
+    def __init__(self, filename, min_compact_bytes=1024*1024):
+        self._filename = filename
+        self._min_compact_bytes = min_compact_bytes
+        self._data = {}
+        self._lock = threading.Lock()
+        self._logger = logging.getLogger(__name__)
+
+    def _path(self, namespace):
+        if namespace == 'timestamps':
+            return self._filename
+        return '%s.%s' % (self._filename, namespace)
+
+    def _namespace(self, namespace):
+        """The cached namespace dict, read on first use. Call with the lock held."""
+        if namespace not in self._data:
+            self._data[namespace] = self._read(namespace)
+        return self._data[namespace]
+
+    def load(self, namespace):
+        """Return a copy of the whole namespace as a dict"""
+        with self._lock:
+            return dict(self._namespace(namespace))
+
+    def _read(self, namespace):
+        """The namespace file with its log replayed on top"""
+        path = self._path(namespace)
+        try:
+            with open(path, 'r') as sfile:
+                data = json.load(sfile)
+        except ValueError:
+            self._logger.warning("State file %s is corrupt, starting empty", path)
+            data = {}
+        except IOError: # File doesn't exist (yet)
+            self._logger.debug("State file %s not found", path)
+            data = {}
+
+        try:
+            with open(path + '.log', 'r') as lfile:
+                for line in lfile:
+                    try:
+                        if not line.endswith('\n'):
+                            raise ValueError(line)
+                        changes = json.loads(line)
+                    except ValueError: # Torn last write
+                        self._logger.warning("Ignoring the incomplete end of %s.log", path)
+                        break
+                    data.update(changes)
+        except IOError:
+            pass
+        return data
+
+    def update(self, namespace, changes):
+        """Set the keys in `changes`, appending them to the namespace log"""
+        if not changes:
+            return
+        with self._lock:
+            self._namespace(namespace).update(changes)
+            path = self._path(namespace)
+            dirname = os.path.dirname(os.path.abspath(path))
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            line = json.dumps(changes) + '\n'
+            with open(path + '.log', 'a+') as lfile:
+                fcntl.flock(lfile, fcntl.LOCK_EX)
+                self._drop_torn_write(lfile)
+                lfile.write(line)
+                lfile.flush()
+                os.fsync(lfile.fileno())
+                log_bytes = lfile.tell()
+                try:
+                    base_bytes = os.path.getsize(path)
+                except OSError:
+                    base_bytes = 0
+                if log_bytes > max(base_bytes, self._min_compact_bytes):
+                    self._compact(namespace, lfile)
+        self._logger.debug("Updated %d entries in %s", len(changes), path)
+
+    def _drop_torn_write(self, lfile, block_size=64*1024):
+        """
+        Cut a log not ending in a newline back to its last complete
+        line, dropping what a crash left half written (see _read)
+        """
+        lfile.seek(0, os.SEEK_END)
+        end = lfile.tell()
+        if end:
+            lfile.seek(end - 1)
+            if lfile.read(1) != '\n':
+                while end:
+                    start = max(0, end - block_size)
+                    lfile.seek(start)
+                    newline = lfile.read(end - start).rfind('\n')
+                    if newline >= 0:
+                        end = start + newline + 1
+                        break
+                    end = start
+                self._logger.warning("Dropping the incomplete end of %s", lfile.name)
+                lfile.truncate(end)
+        lfile.seek(0, os.SEEK_END)
+
+    def _compact(self, namespace, lfile):
+        """
+        Write the whole namespace to its file atomically and empty the
+        log. Call with the lock on the log held: the namespace is read
+        back from both, including what other processes appended.
+        """
+        path = self._path(namespace)
+        self._data[namespace] = data = self._read(namespace)
+        dirname = os.path.dirname(os.path.abspath(path))
+        tmp = tempfile.NamedTemporaryFile('w', dir=dirname, delete=False,
+                                          prefix=os.path.basename(path) + '.')
+        try:
+            json.dump(data, tmp)
+            tmp.flush()
+            os.fsync(tmp.fileno())
+            tmp.close()
+            os.rename(tmp.name, path)
+        except Exception:
+            tmp.close()
+            os.remove(tmp.name)
+            raise
+        # Replaying a log left by a crash right here is harmless, the
+        # new file already has its changes
+        lfile.truncate(0)
+        self._logger.info("Compacted state file %s", path)
+
+    def close(self):
+        pass
+
+
+class SQLiteStateStore(object):
+    """
+    Keeps all namespaces in one SQLite database in WAL mode. Updates
+    only touch the changed keys, in a single transaction.
+
+    :param filename: The database file
+    """
+    def __init__(self, filename):
+        dirname = os.path.dirname(os.path.abspath(filename))
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        self._lock = threading.Lock()
+        self._logger = logging.getLogger(__name__)
+        self._db = sqlite3.connect(filename, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS state ('
+                         'namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT, '
+                         'PRIMARY KEY (namespace, key))')
+        self._db.commit()
+
+    def load(self, namespace):
+        """Return the whole namespace as a dict"""
+        with self._lock:
+            rows = self._db.execute('SELECT key, value FROM state WHERE namespace = ?',
+                                    (namespace,)).fetchall()
+        return dict((key, json.loads(value)) for key, value in rows)
+
+    def update(self, namespace, changes):
+        """Set the keys in `changes` in one transaction"""
+        if not changes:
+            return
+        with self._lock:
+            with self._db:
+                self._db.executemany('INSERT OR REPLACE INTO state (namespace, key, value) VALUES (?, ?, ?)',
+                                     ((namespace, key, json.dumps(value)) for key, value in changes.iteritems()))
+        self._logger.debug("Updated %d entries in namespace %s", len(changes), namespace)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+STATE_BACKENDS = {
+    'json'   : JSONStateStore,
+    'sqlite' : SQLiteStateStore,
+}
+
+def make_state_store(backend, filename):
+    """Instantiate the state store for `backend` ('json' or 'sqlite')"""
+    return STATE_BACKENDS[backend](filename)
@@ -5,26 +5,64 @@ Basic interface to CERN ActiveMQ via stomp
 from __future__ import print_function
 from __future__ import division
 
-import json
+import itertools
 import logging
+import random
+import threading
 import time
 import uuid
+from collections import Counter
+from functools import partial
 
 import stomp
 
+# Only the standard encoder: ujson rounds floats and simplejson encodes
+# namedtuples and Decimals differently, so the bodies would depend on
+# what happens to be installed
+from json import dumps
+
+# Every uuid1 sequence gets its own clock sequence, so that sequences
+# started within the same 100ns tick can't collide
+_clock_seqs = itertools.count(random.getrandbits(14))
+
+def uuid1_strings():
+    """
+    Generate RFC 4122 version 1 UUID strings from a single clock
+    reading, incrementing the 100ns timestamp for each one. About ten
+    times cheaper than calling str(uuid.uuid1()) per notification.
+    """
+    node = uuid.getnode()
+    clock_seq = next(_clock_seqs) & 0x3fff
+    tail = '%02x%02x-%012x' % (((clock_seq >> 8) & 0x3f) | 0x80, clock_seq & 0xff, node)
+    # 100ns intervals since the UUID epoch, 1582-10-15
+    ticks = int(time.time() * 1e7) + 0x01b21dd213814000
+    while True:
+        yield '%08x-%04x-%04x-%s' % (ticks & 0xffffffff, (ticks >> 32) & 0xffff,
+                                     ((ticks >> 48) & 0x0fff) | 0x1000, tail)
+        ticks += 1
+
+
 class StompyListener(object):
     """
     Auxiliar listener class to fetch all possible states in the Stomp
-    connection.
+    connection. Errors, heartbeat timeouts and dropped connections are
+    reported to the rate limiter, if any, to slow down the sends.
     """
-    def __init__(self):
+    def __init__(self, limiter=None):
         self.logr = logging.getLogger(__name__)
+        self.limiter = limiter
+
+    def _penalize(self, reason):
+        limiter = self.limiter
+        if limiter is not None:
+            limiter.penalize(reason)
 
     def on_connecting(self, host_and_port):
         self.logr.info('on_connecting %s', str(host_and_port))
 
     def on_error(self, headers, message):
         self.logr.info('received an error %s %s', str(headers), str(message))
+        self._penalize('error')
 
     def on_message(self, headers, body):
         self.logr.info('on_message %s %s', str(headers), str(body))
@@ -40,9 +78,11 @@ class StompyListener(object):
 
     def on_disconnected(self):
         self.logr.info('on_disconnected')
+        self._penalize('disconnected')
 
     def on_heartbeat_timeout(self):
         self.logr.info('on_heartbeat_timeout')
+        self._penalize('heartbeat timeout')
 
     def on_before_message(self, headers, body):
         self.logr.info('on_before_message %s %s', str(headers), str(body))
@@ -50,6 +90,90 @@ class StompyListener(object):
         return (headers, body)
 
 
+class ReceiptListener(StompyListener):
+    """
+    Listener keeping track of the frames sent with a 'receipt' header
+    until the broker confirms (RECEIPT) or rejects (ERROR) them.
+    The time from sending a frame to its receipt is reported to the
+    rate limiter as the send latency.
+    """
+    def __init__(self, limiter=None):
+        super(ReceiptListener, self).__init__(limiter)
+        self._cond = threading.Condition()
+        self._pending = {} # receipt id -> time sent
+        self.confirmed = set()
+        self.failed = set()
+
+    def add_pending(self, receipt_id):
+        with self._cond:
+            self._pending[receipt_id] = time.time()
+
+    def mark_sent(self, receipt_id):
+        """Start the latency clock of a pending receipt"""
+        with self._cond:
+            if receipt_id in self._pending:
+                self._pending[receipt_id] = time.time()
+
+    def n_pending(self):
+        with self._cond:
+            return len(self._pending)
+
+    def _resolve(self, receipt_id, target):
+        with self._cond:
+            if receipt_id not in self._pending:
+                return
+            latency = time.time() - self._pending.pop(receipt_id)
+            target.add(receipt_id)
+            self._cond.notify_all()
+        limiter = self.limiter
+        if limiter is not None and target is self.confirmed:
+            limiter.observe_latency(latency)
+
+    def on_receipt(self, headers, body):
+        self._resolve(headers.get('receipt-id'), self.confirmed)
+
+    def on_error(self, headers, message):
+        super(ReceiptListener, self).on_error(headers, message)
+        if 'receipt-id' in headers:
+            self._resolve(headers['receipt-id'], self.failed)
+
+    def on_disconnected(self):
+        super(ReceiptListener, self).on_disconnected()
+        # Receipts for frames sent on a dropped connection never arrive
+        with self._cond:
+            self.failed.update(self._pending)
+            self._pending.clear()
+            self._cond.notify_all()
+
+    def forget(self, receipt_ids):
+        """
+        Stop tracking the given receipts, whether they are outstanding,
+        confirmed or failed. A receipt arriving later for one of them
+        is ignored.
+        """
+        with self._cond:
+            for receipt_id in receipt_ids:
+                self._pending.pop(receipt_id, None)
+                self.confirmed.discard(receipt_id)
+                self.failed.discard(receipt_id)
+            self._cond.notify_all()
+
+    def wait(self, max_pending, timeout):
+        """
+        Block until at most `max_pending` receipts are outstanding,
+        or `timeout` seconds have passed. Returns True if the window
+        opened in time.
+        """
+        deadline = time.time() + timeout
+        with self._cond:
+            while len(self._pending) > max_pending:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+
 class StompAMQ(object):
     """
     Class to generate and send notifications to a given Stomp broker
@@ -61,6 +185,21 @@ class StompAMQ(object):
     :param topic: The topic to be used on the broker
     :param host_and_ports: The hosts and ports list of the brokers.
         E.g.: [('agileinf-mb.cern.ch', 61213)]
+    :param receipts: Request a receipt for every frame and only report
+        notifications confirmed by the broker as sent
+    :param window: Maximum number of unconfirmed frames in flight
+        when using receipts
+    :param receipt_timeout: Seconds to wait for outstanding receipts
+    :param batch_size: Maximum number of notifications packed into one
+        frame as a JSON array (1: one frame per notification)
+    :param batch_bytes: Maximum body size of a packed frame
+    :param spool: Optional NotificationSpool keeping the notifications
+        that could not be sent, to be sent first on the next connection
+    :param limiter: Optional AdaptiveRateLimiter pacing the frames sent,
+        slowed down on broker errors, heartbeat timeouts, dropped
+        connections and high send (or receipt) latency
+    :param heartbeat: STOMP heartbeat interval in ms, to detect a
+        stalled broker (0: no heartbeats)
     """
 
     # Version number to be added in header
@@ -69,72 +208,375 @@ class StompAMQ(object):
     def __init__(self, username, password,
                  producer='CMS_WMCore_StompAMQ',
                  topic='/topic/cms.jobmon.wmagent',
-                 host_and_ports=None):
+                 host_and_ports=None,
+                 receipts=False,
+                 window=100,
+                 receipt_timeout=30,
+                 batch_size=1,
+                 batch_bytes=256*1024,
+                 spool=None,
+                 limiter=None,
+                 heartbeat=0):
         self._host_and_ports = host_and_ports or [('agileinf-mb.cern.ch', 61213)]
         self._username = username
         self._password = password
         self._producer = producer
         self._topic = topic
 
+        self._receipts = receipts
+        self._window = max(1, window)
+        self._receipt_timeout = receipt_timeout
+        self._batch_size = max(1, batch_size)
+        self._batch_bytes = batch_bytes
+        self._spool = spool
+        self._drain_lock = threading.Lock()
+        self._limiter = limiter
+        self._heartbeat = heartbeat
+
+        self._conn = None
+        self._listener = None
+        self._lock = threading.RLock()
+        self.sent_counts = Counter()
+        self.serialize_seconds = Counter() # per type
+        self.sent_bytes = Counter() # frame bodies, per type
+        self.throttle_seconds = Counter() # waiting for the limiter, per type
+
         self._logger = logging.getLogger(__name__)
 
-    def send(self, data):
+    def connect(self):
         """
-        Connect to the stomp host and send a single notification
-        (or a list of notifications).
+        Open a connection to the broker, to be reused by all subsequent
+        `send` calls until `disconnect` is called. Does nothing if
+        already connected.
 
-        :param data: Either a single notification (as returned by
-            `make_notification`) or a list of such.
+        A new connection first sends whatever is in the spool.
 
-        :return: a list of successfully sent notification bodies
+        :return: True if connected
+        """
+        with self._lock:
+            was_connected = self._conn is not None and self._conn.is_connected()
+            connected = self._connect()
+        if connected and not was_connected and self._spool is not None:
+            self.drain_spool()
+        return connected
+
+    def drain_spool(self):
         """
+        Send the spooled notifications, oldest first, through the
+        batched path. Only one thread drains at a time.
 
-        conn = stomp.Connection(host_and_ports=self._host_and_ports)
-        conn.set_listener('StompyListener', StompyListener())
+        :return: the number of notifications sent
+        """
+        if not self._drain_lock.acquire(False):
+            return 0
+        try:
+            return self._spool.drain(partial(self._send, spool=False))
+        except Exception:
+            self._logger.exception("Failed to drain the spool %s", self._spool.directory)
+            return 0
+        finally:
+            self._drain_lock.release()
+
+    def has_spooled(self):
+        """Whether there are spooled notifications left to send"""
+        return self._spool is not None and bool(self._spool.segments())
+
+    def _connect(self):
+        if self._conn is not None and self._conn.is_connected():
+            return True
+
+        conn = stomp.Connection(host_and_ports=self._host_and_ports,
+                                heartbeats=(self._heartbeat, self._heartbeat))
+        listener = ReceiptListener(self._limiter)
+        if self._listener is not None:
+            # Keep the receipts confirmed on a previous connection
+            listener.confirmed = self._listener.confirmed
+            listener.failed = self._listener.failed
+        self._listener = listener
+        conn.set_listener('StompyListener', listener)
         try:
             conn.start()
             conn.connect(username=self._username, passcode=self._password, wait=True)
         except stomp.exception.ConnectFailedException as exc:
             self._logger.error("Connection to %s failed %s", repr(self._host_and_ports), str(exc))
-            return []
+            return False
+
+        self._conn = conn
+        return True
+
+    def disconnect(self):
+        """
+        Close the connection opened by `connect` and report the number
+        of notifications sent per type over it
+        """
+        with self._lock:
+            if self._conn is not None and self._conn.is_connected():
+                # Not a sign of trouble for the rate limiter
+                self._listener.limiter = None
+                self._conn.disconnect()
+            self._conn = None
+
+        for type_, count in sorted(self.sent_counts.items()):
+            self._logger.info('Sent %d docs of type %s to %s', count, type_, repr(self._host_and_ports))
+
+    def __enter__(self):
+        self.connect()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.disconnect()
+
+    def send(self, data, spooled=None):
+        """
+        Send a single notification (or a list of notifications).
+
+        Uses the connection opened by `connect` if there is one,
+        otherwise connects and disconnects around this call.
+        A dropped connection is re-established once per notification.
+        Several threads may send over the same open connection.
+
+        With batch_size > 1, consecutive notifications with the same
+        headers are packed into JSON array frames (see `_batch`).
+        Notifications that could not be sent go to the spool, if any.
+
+        :param data: Either a single notification (as returned by
+            `make_notification`) or a list of such.
+        :param spooled: Optional list, gets the bodies of the
+            notifications that went to the spool. These are sent by a
+            later drain and should not be sent again by the caller.
 
+        :return: a list of successfully sent notification bodies
+        """
+        return self._send(data, spool=self._spool is not None, spooled=spooled)
+
+    def _send(self, data, spool=False, spooled=None):
         # If only a single notification, put it in a list
         if isinstance(data, dict) and 'topic' in data:
             data = [data]
 
-        successfully_sent = []
-        for notification in data:
-            body = self._send_single(conn, notification)
-            if body:
-                successfully_sent.append(body)
+        session = self._conn is not None
+        if not self.connect():
+            if spool:
+                self._spool_write(data, spooled)
+            return []
 
-        if conn.is_connected():
-            conn.disconnect()
+        on_failure = None
+        if spool:
+            failed = []
+            def on_failure(notification):
+                # Spool the failures as they come, a segment at a time
+                failed.extend(self._unbatch(notification))
+                if len(failed) >= self._spool.segment_docs:
+                    self._spool_write(failed, spooled)
+                    del failed[:]
+
+        if self._batch_size > 1:
+            data = self._batch(data)
+
+        if self._receipts:
+            successfully_sent = self._send_with_receipts(data, on_failure=on_failure)
+        else:
+            successfully_sent = []
+            for notification in data:
+                if self._send_or_reconnect(notification) is not None:
+                    bodies = notification.get('bodies', [notification['body']])
+                    successfully_sent.extend(bodies)
+                    self._count_sent(notification.get('type'), len(bodies))
+                elif on_failure is not None:
+                    on_failure(notification)
+
+        if not session:
+            self.disconnect()
+
+        if spool and failed:
+            self._spool_write(failed, spooled)
 
         self._logger.warning('Sent %d docs to %s', len(successfully_sent), repr(self._host_and_ports))
         return successfully_sent
 
-    def _send_single(self, conn, notification):
+    def _spool_write(self, notifications, spooled=None):
+        """Spool the notifications, adding their bodies to `spooled`"""
+        if spooled is not None:
+            notifications = self._record(notifications, spooled)
+        self._spool.write(notifications)
+
+    @staticmethod
+    def _record(data, spooled):
+        """Pass the notifications through, keeping their bodies in `spooled`"""
+        for notification in data:
+            spooled.append(notification['body'])
+            yield notification
+
+    @staticmethod
+    def _unbatch(notification):
+        """The single notifications packed into a frame by `_batch`"""
+        if 'bodies' not in notification:
+            return [notification]
+        headers = dict((k, v) for k, v in notification.items() if k not in ('body', 'bodies'))
+        return [dict(headers, body=body) for body in notification['bodies']]
+
+    def _send_or_reconnect(self, notification, receipt=None):
+        """
+        Send a single notification over the current connection,
+        reconnecting once if it was dropped
+
+        :return: The notification body in case of success, or else None
+        """
+        conn = self._conn
+        if conn is None:
+            return None
+        body = self._send_single(conn, notification, receipt=receipt)
+        if body is None and not conn.is_connected():
+            with self._lock:
+                # Another thread may have reconnected already
+                if self._conn is conn:
+                    self._logger.warning('Lost connection to %s, reconnecting', repr(self._host_and_ports))
+                    self._conn = None
+                if not self._connect():
+                    return None
+                conn = self._conn
+                if receipt is not None:
+                    self._listener.add_pending(receipt)
+            body = self._send_single(conn, notification, receipt=receipt)
+        return body
+
+    def _count_sent(self, type_, count=1):
+        with self._lock:
+            self.sent_counts[type_] += count
+
+    def _encode(self, type_, body):
+        """
+        Serialize a notification body, accounting the time per type.
+        Payloads with a to_dict method (e.g. DocRecords) become dicts here.
+        """
+        start = time.time()
+        if hasattr(body['payload'], 'to_dict'):
+            body = dict(body, payload=body['payload'].to_dict())
+        encoded = dumps(body)
+        elapsed = time.time() - start
+        with self._lock:
+            self.serialize_seconds[type_] += elapsed
+        return encoded
+
+    def _batch(self, data):
+        """
+        Pack consecutive notifications with identical headers into
+        frames of at most `batch_size` notifications and `batch_bytes`
+        of body. Each body keeps its own payload and metadata.
+
+        :return: a generator of notifications whose 'body' is the
+            serialized JSON array, with the original bodies in 'bodies'
+        """
+        batch, size, batch_headers = [], 0, None
+        for notification in data:
+            headers = dict((k, v) for k, v in notification.items() if k != 'body')
+            encoded = self._encode(notification.get('type'), notification['body'])
+            if batch and (headers != batch_headers or
+                          len(batch) >= self._batch_size or
+                          size + len(encoded) + 1 > self._batch_bytes):
+                yield self._make_batch(batch_headers, batch)
+                batch, size = [], 0
+            batch.append((notification['body'], encoded))
+            size += len(encoded) + 1
+            batch_headers = headers
+        if batch:
+            yield self._make_batch(batch_headers, batch)
+
+    @staticmethod
+    def _make_batch(headers, batch):
+        notification = dict(headers)
+        notification['body'] = '[%s]' % ','.join(encoded for _, encoded in batch)
+        notification['bodies'] = [body for body, _ in batch]
+        return notification
+
+    def _send_with_receipts(self, data, on_failure=None):
+        """
+        Send notifications with a receipt request each, keeping at most
+        `window` of them unconfirmed at any time
+
+        :param on_failure: Optional callable, called with each frame
+            that was not confirmed, or not even sent after a timeout
+
+        :return: the bodies of the notifications confirmed by the broker,
+            in the order they were sent
+        """
+        in_flight = []
+        data = iter(data)
+        for notification in data:
+            if not self._listener.wait(self._window - 1, self._receipt_timeout):
+                self._logger.error('Timed out waiting for receipts from %s', repr(self._host_and_ports))
+                if on_failure is not None:
+                    on_failure(notification)
+                    for notification in data:
+                        on_failure(notification)
+                break
+            receipt = str(uuid.uuid4())
+            self._listener.add_pending(receipt)
+            if self._send_or_reconnect(notification, receipt=receipt) is not None:
+                in_flight.append((receipt, notification))
+            else:
+                self._listener.forget([receipt])
+                if on_failure is not None:
+                    on_failure(notification)
+
+        if not self._listener.wait(0, self._receipt_timeout):
+            self._logger.error('%d receipts still outstanding from %s',
+                               self._listener.n_pending(), repr(self._host_and_ports))
+
+        confirmed = self._listener.confirmed
+        successfully_sent = []
+        for receipt, notification in in_flight:
+            if receipt in confirmed:
+                bodies = notification.get('bodies', [notification['body']])
+                successfully_sent.extend(bodies)
+                self._count_sent(notification.get('type'), len(bodies))
+            elif on_failure is not None:
+                on_failure(notification)
+        # Including the outstanding ones, which would otherwise hold the
+        # window of every later send on this connection
+        self._listener.forget([receipt for receipt, _ in in_flight])
+        return successfully_sent
+
+    def _send_single(self, conn, notification, receipt=None):
         """
         Send a single notification to `conn`
 
         :param conn: An already connected stomp.Connection
         :param notification: A dictionary as returned by `make_notification`
+        :param receipt: Optional receipt id to request from the broker
 
         :return: The notification body in case of success, or else None
         """
+        headers = dict((k, v) for k, v in notification.items() if k not in ('body', 'bodies', 'topic'))
+        if receipt is not None:
+            headers['receipt'] = receipt
+        limiter = self._limiter
         try:
-            body = notification.pop('body')
-            destination = notification.pop('topic')
+            body = notification['body']
+            destination = notification['topic']
+            encoded = body if 'bodies' in notification else self._encode(headers.get('type'), body)
+            if limiter is not None:
+                waited = limiter.acquire(len(encoded))
+                with self._lock:
+                    self.throttle_seconds[headers.get('type')] += waited
+                if receipt is not None:
+                    self._listener.mark_sent(receipt)
+            start = time.time()
             conn.send(destination=destination,
-                      headers=notification,
-                      body=json.dumps(body),
+                      headers=headers,
+                      body=encoded,
                       ack='auto')
-            self._logger.debug('Notification %s sent', str(notification))
+            if limiter is not None and receipt is None:
+                limiter.observe_latency(time.time() - start)
+            with self._lock:
+                self.sent_bytes[headers.get('type')] += len(encoded)
+            self._logger.debug('Notification %s sent', str(headers))
             return body
         except Exception as exc:
             self._logger.error('Notification: %s not send, error: %s',
-                          str(notification), str(exc))
+                          str(headers), str(exc))
+            if limiter is not None:
+                limiter.penalize('send failure')
             return None
 
 
@@ -150,31 +592,40 @@ class StompAMQ(object):
 
         :return: the generated notification
         """
-        producer = producer or self._producer
+        return next(self.make_notifications([(payload, id_)], producer=producer, type_=type_))
+
+    def make_notifications(self, payloads, producer=None,
+                           type_='cms_wmagent_info'):
+        """
+        Lazily generate notifications for a stream of payloads of the
+        same type. The header block is built once, all notifications
+        share one metadata timestamp and get their uuids from one
+        `uuid1_strings` sequence.
 
-        notification = {}
-        notification['topic'] = self._topic
+        :param payloads: An iterable of (payload, id_) pairs
+        :param producer: The notification producer.
+            Default: StompAMQ._producer
 
-        # Add headers
+        :return: a generator of notifications, as `make_notification`
+        """
         headers = {
-                   'type': type_,
-                   'version': self._version,
-                   'producer': producer
+            'topic': self._topic,
+            'type': type_,
+            'version': self._version,
+            'producer': producer or self._producer,
         }
-
-        notification.update(headers)
-
-        # Add body consisting of the payload and metadata
-        body = {
-            'payload': payload,
-            'metadata': {
-                'timestamp': int(time.time()),
-                'id': id_,
-                'uuid': str(uuid.uuid1()),
+        timestamp = int(time.time())
+        uuids = uuid1_strings()
+
+        for payload, id_ in payloads:
+            # Add body consisting of the payload and metadata
+            notification = headers.copy()
+            notification['body'] = {
+                'payload': payload,
+                'metadata': {
+                    'timestamp': timestamp,
+                    'id': id_,
+                    'uuid': next(uuids),
+                }
             }
-        }
-
-        notification['body'] = body
-
-        return notification
-    
+            yield notification
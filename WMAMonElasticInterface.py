@@ -2,22 +2,47 @@
 import os
 import json
 import time
+import hashlib
 import logging
+import datetime
+import threading
 
 from elasticsearch import Elasticsearch
 from elasticsearch import helpers
+from elasticsearch.serializer import JSONSerializer
 
 from elasticsearch.exceptions import ConnectionError
 from elasticsearch.exceptions import ConnectionTimeout
 
 def replace_id(doc):
     """Elastic doesn't like _id fields. Rename field name to _id_prev"""
+    if '_id' not in doc: # e.g. DocRecords, which have no _id
+        return doc
     _id = doc.pop('_id', None)
     if _id:
         doc['_id_prev'] = _id
     return doc
 
-def helpers_bulk_syntax(doc, index_name, type_name, action='index'):
+# Fields identifying a document within one agent report, per doc type
+DOC_ID_KEYS = {
+    'agent_info'    : (),
+    'site_info'     : ('site_name',),
+    'priority_info' : ('site_name', 'priority'),
+    'work_info'     : ('status',),
+    'site_rollup'   : ('site_name',),
+}
+
+def make_doc_id(doc, doc_type):
+    """
+    Deterministic document id derived from the doc type, agent_url,
+    timestamp and the fields in DOC_ID_KEYS. Re-injecting the same
+    report then maps onto the same ids.
+    """
+    parts = [doc_type, doc.get('agent_url'), doc['timestamp']]
+    parts.extend(doc.get(key) for key in DOC_ID_KEYS.get(doc_type, ()))
+    return hashlib.sha1(u'|'.join(u'%s' % p for p in parts).encode('utf-8')).hexdigest()
+
+def helpers_bulk_syntax(doc, index_name, type_name, action='index', doc_id=None):
     """See: http://elasticsearch-py.readthedocs.org/en/
             master/helpers.html#elasticsearch.helpers.bulk"""
     action = {
@@ -26,8 +51,29 @@ def helpers_bulk_syntax(doc, index_name, type_name, action='index'):
         '_type'    : type_name,
         '_source'  : replace_id(doc) # the actual document
     }
+    if doc_id is not None:
+        action['_id'] = doc_id
     return action
 
+# Bulk item statuses worth retrying: too many requests, service unavailable
+RETRY_STATUSES = (429, 503)
+
+def exists_query(timestamp, agent_url):
+    """Query matching the docs with this timestamp and agent_url"""
+    query = {
+                "query": {
+                    "bool": {
+                        "must": [
+                            { "match" : { "timestamp": str(timestamp) } },
+                            { "match" : { "agent_url": str(agent_url) } }
+                        ]
+                    }
+                },
+                "size" : 1,
+                "_source" : ["timestamp", "agent_url"]
+            }
+    return query
+
 def wma_mapping(doc_type="agent_info"):
     mapping = {
         "mappings" : {
@@ -52,33 +98,127 @@ def wma_mapping(doc_type="agent_info"):
     }
     return mapping
 
+# Time-partitioned index names are <prefix>-<date>, matched by <prefix>-2*,
+# which doesn't match other doc types' indices like <prefix>-sites-<date>
+INDEX_PERIODS = {
+    'daily'  : lambda day: day.strftime('%Y.%m.%d'),
+    'weekly' : lambda day: '%04d.w%02d' % day.isocalendar()[:2],
+}
+
+def index_for_timestamp(prefix, timestamp, period):
+    """Name of the time-partitioned index holding docs from `timestamp`"""
+    day = datetime.datetime.utcfromtimestamp(float(timestamp))
+    return '%s-%s' % (prefix, INDEX_PERIODS[period](day))
+
+def index_date(index_name, prefix, period):
+    """Start date of a time-partitioned index, or None if it isn't one"""
+    suffix = index_name[len(prefix)+1:]
+    try:
+        if period == 'weekly':
+            year, week = suffix.split('.w')
+            # Monday of that ISO week
+            jan4 = datetime.date(int(year), 1, 4)
+            return jan4 + datetime.timedelta(days=7*(int(week)-1) - jan4.weekday())
+        return datetime.datetime.strptime(suffix, '%Y.%m.%d').date()
+    except ValueError:
+        return None
+
+# Bump when wma_template changes, to replace the installed templates
+TEMPLATE_VERSION = 1
+
+def wma_template(prefix, doc_type="agent_info"):
+    """Index template applying wma_mapping to all partitions of `prefix`"""
+    template = wma_mapping(doc_type=doc_type)
+    template['template'] = '%s-2*' % prefix
+    template['version'] = TEMPLATE_VERSION
+    return template
+
+class RecordSerializer(JSONSerializer):
+    """Also serializes objects with a to_dict method, e.g. DocRecords"""
+    def default(self, data):
+        if hasattr(data, 'to_dict'):
+            return data.to_dict()
+        return JSONSerializer.default(self, data)
+
+_clients = {} # (hosts, maxsize, timeout, keep_alive) -> [Elasticsearch, connection verified]
+_clients_lock = threading.Lock()
+def get_client(hosts=None, maxsize=10, timeout=30, keep_alive=True):
+    """
+    Return the Elasticsearch client for these hosts and settings, shared
+    by all interfaces in this process. Its urllib3 connection pools keep
+    up to `maxsize` keep-alive connections per host. Without `keep_alive`
+    every request asks the server to close its connection, e.g. behind
+    a proxy that mishandles idle ones.
+    """
+    key = (tuple(hosts or ()), maxsize, timeout, keep_alive)
+    with _clients_lock:
+        if key not in _clients:
+            headers = None if keep_alive else {'connection': 'close'}
+            _clients[key] = [Elasticsearch(hosts=hosts, maxsize=maxsize, timeout=timeout,
+                                           headers=headers, retry_on_timeout=True,
+                                           serializer=RecordSerializer()),
+                             False]
+        return _clients[key]
+
+_installed_templates = set() # template names checked or installed by this process
+
 class WMAMonElasticInterface(object):
     """docstring for WMAMonElasticInterface"""
     def __init__(self,
                  doc_type='agent_info',
                  index_name='wmamon',
                  recreate=False,
-                 hosts=None):
+                 hosts=None,
+                 bulk_threads=1,
+                 chunk_size=1000,
+                 max_chunk_bytes=10*1024*1024,
+                 max_retries=3,
+                 initial_backoff=2,
+                 max_backoff=60,
+                 index_period=None,
+                 pool_maxsize=10,
+                 timeout=30,
+                 keep_alive=True):
         self.doc_type = doc_type
         self.index_name = None
+        self.index_period = index_period
         self.logger = logging.getLogger(__name__)
 
-        self.es_handle = Elasticsearch(hosts=hosts)
+        self.bulk_threads = bulk_threads
+        self.chunk_size = chunk_size
+        self.max_chunk_bytes = max_chunk_bytes
+        self.max_retries = max_retries
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+
+        self._client = get_client(hosts, maxsize=pool_maxsize, timeout=timeout,
+                                  keep_alive=keep_alive)
+        self.es_handle = self._client[0]
         if not self.check_connection():
             return
 
+        if self.index_period:
+            # index_name is the prefix of the partitions
+            self.index_name = index_name
+            self.install_template()
+            return
+
         self.make_index(index_name, recreate=recreate,
                         mappings=json.dumps(wma_mapping(doc_type=self.doc_type)))
 
     def check_connection(self):
-        try:
-            self.es_handle.ping()
+        """Ping the cluster, only once per shared client"""
+        if self._client[1]:
             self.connected = True
             return True
+        try:
+            self.connected = self.es_handle.ping()
         except ConnectionError:
-            self.logger.critical("Elasticsearch connection failed")
             self.connected = False
-            return False
+        if not self.connected:
+            self.logger.critical("Elasticsearch connection failed")
+        self._client[1] = self.connected
+        return self.connected
 
     def make_index(self, name, recreate=False, mappings=None):
         """Create the index and set mappings and settings"""
@@ -99,36 +239,173 @@ class WMAMonElasticInterface(object):
 
         return self.index_name
 
-    def bulk_inject_from_list(self, docs):
-        self.logger.debug("Injecting from list with %d documents" % len(docs))
+    def install_template(self):
+        """
+        Install the index template for the partitions, unless the
+        current version is already installed. Checked once per process.
+        The partitions are created by the bulk requests, with the
+        mappings of the template.
+        """
+        if self.index_name in _installed_templates:
+            return
+        try:
+            installed = self.es_handle.indices.get_template(name=self.index_name, ignore=404)
+            if installed.get(self.index_name, {}).get('version') == TEMPLATE_VERSION:
+                _installed_templates.add(self.index_name)
+                self.logger.debug("Using existing index template %s" % self.index_name)
+                return
+            self.es_handle.indices.put_template(name=self.index_name,
+                                                body=json.dumps(wma_template(self.index_name,
+                                                                             doc_type=self.doc_type)))
+            _installed_templates.add(self.index_name)
+            self.logger.info("Installed index template %s" % self.index_name)
+        except Exception, msg:
+            self.logger.error("Failed to install index template: %s" % str(msg))
 
-        actions = (helpers_bulk_syntax(d, index_name=self.index_name, type_name=self.doc_type) for d in docs)
+    def index_for(self, timestamp):
+        """The index for docs from `timestamp`"""
+        if not self.index_period:
+            return self.index_name
+        return index_for_timestamp(self.index_name, timestamp, self.index_period)
 
-        start_time = time.time()
+    def delete_old_indices(self, retention_days):
+        """
+        Delete the partitions whose period started more than
+        `retention_days` ago
 
+        :return: the list of deleted indices
+        """
+        if not self.index_period or not retention_days:
+            return []
+        cutoff = datetime.datetime.utcnow().date() - datetime.timedelta(days=retention_days)
+        if self.index_period == 'weekly':
+            cutoff -= datetime.timedelta(days=6) # keep weeks partly within the retention
         try:
-            res = helpers.bulk(self.es_handle, actions, chunk_size=1000,
-                               raise_on_error=False,
-                               raise_on_exception=False)
+            existing = self.es_handle.indices.get_alias(index='%s-2*' % self.index_name)
         except Exception, msg:
-            self.logger.error("Failed to inject: %s" % str(msg))
+            self.logger.error("Failed to list indices: %s" % str(msg))
+            return []
+
+        old = sorted(name for name in existing
+                     if (index_date(name, self.index_name, self.index_period) or cutoff) < cutoff)
+        for name in old:
+            try:
+                self.es_handle.indices.delete(index=name)
+                self.logger.warning("Deleted index %s" % name)
+            except Exception, msg:
+                self.logger.error("Failed to delete index %s: %s" % (name, str(msg)))
+        return old
+
+    def bulk_inject(self, docs, op_type='index', with_ids=False):
+        """
+        Bulk inject docs with streaming_bulk, or parallel_bulk if
+        bulk_threads > 1. Items rejected with 429 or 503 (also when the
+        whole request fails with these) are retried, alone, with
+        exponential backoff up to max_retries times.
+
+        :return: a dict with the 'success', 'existing' (409 conflicts
+            from 'create' ops), 'failed' and 'retried' counts, the
+            'elapsed' time and one {'_id', 'status', 'ok', 'error'}
+            dict per doc in 'items', in the order of `docs`
+        """
+        self.logger.debug("Injecting from list with %d documents" % len(docs))
 
-        elapsed = time.time()-start_time
+        actions = [helpers_bulk_syntax(d, index_name=self.index_for(d['timestamp']), type_name=self.doc_type,
+                                       action=op_type,
+                                       doc_id=make_doc_id(d, self.doc_type) if with_ids else None)
+                   for d in docs]
+        items = [None] * len(actions)
+        pending = range(len(actions))
+        n_retried = 0
 
-        if len(docs) - res[0] > 0:
-            self.logger.error("Failed to inject %d of %d docs, printing first error message" % (len(docs)-res[0], len(docs)))
+        start_time = time.time()
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                backoff = min(self.max_backoff, self.initial_backoff * 2 ** (attempt - 1))
+                self.logger.warning("Retrying %d rejected docs in %.0f seconds" % (len(pending), backoff))
+                time.sleep(backoff)
+                n_retried += len(pending)
+
+            retry = []
             try:
-                self.logger.error(res[1][0].get('index').get('error'))
-            except (IndexError, AttributeError):
-                self.logger.error(repr(res))
-        else:
-            self.logger.warning("Injected %d docs to %s in %.1f seconds" % (res[0], self.index_name, elapsed))
+                for idx, (ok, result) in zip(pending, self._bulk_stream([actions[i] for i in pending])):
+                    info = result.values()[0] if result else {}
+                    items[idx] = {'_id': info.get('_id'), 'status': info.get('status'),
+                                  'ok': ok, 'error': None if ok else info.get('error')}
+                    if not ok and info.get('status') in RETRY_STATUSES:
+                        retry.append(idx)
+            except Exception, msg:
+                self.logger.error("Failed to inject: %s" % str(msg))
+                break
+            pending = retry
+            if not pending:
+                break
 
+        for idx, item in enumerate(items):
+            if item is None:
+                items[idx] = {'_id': None, 'status': None, 'ok': False, 'error': 'not sent'}
+
+        res = {
+            'success'  : sum(1 for i in items if i['ok']),
+            'existing' : sum(1 for i in items if i['status'] == 409),
+            'retried'  : n_retried,
+            'elapsed'  : time.time() - start_time,
+            'items'    : items,
+        }
+        res['failed'] = len(items) - res['success'] - res['existing']
+
+        if res['existing']:
+            self.logger.info("Skipped %d of %d docs already in %s" % (res['existing'], len(docs), self.index_name))
+        if res['failed']:
+            self.logger.error("Failed to inject %d of %d docs, printing first error message" % (res['failed'], len(docs)))
+            self.logger.error(next(i['error'] for i in items if not i['ok'] and i['status'] != 409))
+        else:
+            self.logger.warning("Injected %d docs to %s in %.1f seconds" % (res['success'], self.index_name, res['elapsed']))
 
         return res
 
-    def bulk_inject_from_list_checked(self, docs):
-        checked_docs = [d for d in docs if not self.check_if_exists(d['timestamp'], d['agent_url'])]
+    def _bulk_stream(self, actions):
+        """(ok, item) for every action, in order"""
+        if self.bulk_threads > 1:
+            return helpers.parallel_bulk(self.es_handle, actions,
+                                         thread_count=self.bulk_threads,
+                                         chunk_size=self.chunk_size,
+                                         max_chunk_bytes=self.max_chunk_bytes,
+                                         raise_on_error=False,
+                                         raise_on_exception=False)
+        return helpers.streaming_bulk(self.es_handle, actions,
+                                      chunk_size=self.chunk_size,
+                                      max_chunk_bytes=self.max_chunk_bytes,
+                                      raise_on_error=False,
+                                      raise_on_exception=False)
+
+    def bulk_inject_from_list(self, docs, op_type='index', with_ids=False):
+        """
+        Same as bulk_inject, returning (number of docs injected, errors)
+        like elasticsearch.helpers.bulk
+        """
+        res = self.bulk_inject(docs, op_type=op_type, with_ids=with_ids)
+        return res['success'], [i for i in res['items'] if not i['ok']]
+
+    def bulk_inject_from_list_checked(self, docs, dedup='id'):
+        """
+        Inject only the docs that are not yet in the index.
+
+        :param dedup: How to find existing docs:
+            'id'      - deterministic ids with 'create' ops, existing docs
+                        are rejected by ES within the bulk call itself
+            'msearch' - one batched multi-search per chunk of docs
+            'search'  - one search per doc
+            The searches match on timestamp and agent_url, so docs without
+            an agent_url (the site rollups) always use 'id'.
+        """
+        if dedup == 'id' or any('agent_url' not in d for d in docs):
+            return self.bulk_inject_from_list(docs, op_type='create', with_ids=True)
+        elif dedup == 'msearch':
+            exists = self.check_if_exists_batch(docs)
+            checked_docs = [d for d, e in zip(docs, exists) if not e]
+        else:
+            checked_docs = [d for d in docs if not self.check_if_exists(d['timestamp'], d['agent_url'])]
         self.logger.debug("Found %d new docs" % len(checked_docs))
         if not len(checked_docs):
             self.logger.warning("Found no new docs")
@@ -137,7 +414,8 @@ class WMAMonElasticInterface(object):
 
     def inject_single(self, doc):
         doc = replace_id(doc)
-        res = self.es_handle.index(index=self.index_name, doc_type=self.doc_type, body=doc)
+        index_name = self.index_for(doc['timestamp'])
+        res = self.es_handle.index(index=index_name, doc_type=self.doc_type, body=doc)
         if not res[0]:
             self.logger.error("Failed to inject doc, printing error message")
             try:
@@ -154,22 +432,31 @@ class WMAMonElasticInterface(object):
         return None
 
     def check_if_exists(self, timestamp, agent_url):
-        query = {
-                    "query": {
-                        "bool": {
-                            "must": [
-                                { "match" : { "timestamp": str(timestamp) } },
-                                { "match" : { "agent_url": str(agent_url) } }
-                            ]
-                        }
-                    },
-                    "size" : 1,
-                    "_source" : ["timestamp", "agent_url"]
-                }
+        query = exists_query(timestamp, agent_url)
         try:
-            res = self.es_handle.search(body=json.dumps(query), index=self.index_name, timeout='5s')
+            res = self.es_handle.search(body=json.dumps(query), index=self.index_for(timestamp),
+                                        timeout='5s', ignore_unavailable=True)
         except Exception, msg:
             self.logger.error('Error searching for existing docs: %s' % str(msg))
             return False
         return res['hits']['total'] > 0
 
+    def check_if_exists_batch(self, docs, chunk_size=1000):
+        """
+        Same as check_if_exists, for a list of docs, with one
+        msearch request per chunk. Returns a list of booleans.
+        """
+        exists = []
+        for start in range(0, len(docs), chunk_size):
+            chunk = docs[start:start+chunk_size]
+            body = []
+            for doc in chunk:
+                body.append({'index': self.index_for(doc['timestamp']), 'ignore_unavailable': True})
+                body.append(exists_query(doc['timestamp'], doc['agent_url']))
+            try:
+                res = self.es_handle.msearch(body=body)
+                exists.extend(r.get('hits', {}).get('total', 0) > 0 for r in res['responses'])
+            except Exception, msg:
+                self.logger.error('Error searching for existing docs: %s' % str(msg))
+                exists.extend(False for _ in chunk)
+        return exists
@@ -0,0 +1,242 @@
+#! /usr/bin/env python
+"""
+Benchmark the post_agentinfo processing pipeline on synthetic
+WMStats agentInfo payloads
+"""
+from __future__ import print_function
+from __future__ import division
+
+import sys
+import json
+import time
+import random
+import logging
+from argparse import ArgumentParser
+from StringIO import StringIO
+
+import post_agentinfo
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+try:
+    import resource
+except ImportError:
+    resource = None
+
+LWQ_STATUSES = ['Available', 'Acquired', 'Negotiating', 'Running', 'Done',
+                'Failed', 'Canceled', 'CancelRequested']
+
+def generate_agentinfo(n_agents=50, n_sites=300, n_priorities=5, n_statuses=4,
+                       n_central=2, seed=42, base_timestamp=1500000000):
+    """
+    Deterministically generate a WMStats agentInfo view response with
+    `n_agents` agent rows (plus `n_central` central service rows), each
+    reporting `n_sites` sites, `n_priorities` priorities per site and
+    `n_statuses` LocalWQ statuses, with timestamps within an hour
+    after `base_timestamp`
+    """
+    rand = random.Random(seed)
+    sites = ['T%d_%s_Site%04d' % (i % 3 + 1, ['CH', 'US', 'DE', 'IT', 'FR'][i % 5], i)
+             for i in range(n_sites)]
+    priorities = [str(1000 * (10 ** (i % 4)) + i) for i in range(n_priorities)]
+    statuses = [LWQ_STATUSES[i % len(LWQ_STATUSES)] + ('' if i < len(LWQ_STATUSES) else str(i))
+                for i in range(n_statuses)]
+
+    rows = []
+    for i in range(n_agents):
+        agent_url = 'vocms%04d.cern.ch:9999' % i
+        thresholds = {}
+        for site in sites:
+            thresholds[site] = {
+                'state': rand.choice(['Normal', 'Normal', 'Normal', 'Draining', 'Down']),
+                'pending_slots': rand.randint(0, 5000),
+                'running_slots': rand.randint(0, 20000),
+                'task_thresholds': dict((task, rand.randint(0, 1000))
+                                        for task in ['Processing', 'Production', 'Merge']),
+            }
+        possibleJobsPerSite = {}
+        uniqueJobsPerSite = {}
+        for status in statuses:
+            possibleJobsPerSite[status] = [{'site_name': site,
+                                            'Jobs': rand.randint(0, 100000),
+                                            'NumElems': rand.randint(0, 500)}
+                                           for site in sites if rand.random() < 0.8]
+            uniqueJobsPerSite[status] = [{'site_name': site,
+                                          'Jobs': rand.randint(0, 100000),
+                                          'NumElems': rand.randint(0, 500)}
+                                         for site in sites if rand.random() < 0.5]
+        value = {
+            '_id': agent_url,
+            '_rev': '%d-%032x' % (rand.randint(1, 100), rand.getrandbits(128)),
+            'acdc': {'status': 'ok'},
+            'agent_url': agent_url,
+            'agent_team': 'production',
+            'agent_version': '1.1.10',
+            'status': 'ok',
+            'timestamp': base_timestamp + rand.randint(0, 3600),
+            'WMBS_INFO': {
+                'thresholds': thresholds,
+                'thresholdsGQ2LQ': dict((site, rand.randint(0, 10000))
+                                        for site in sites if rand.random() < 0.7),
+                'sitePendCountByPrio': dict((site, dict((prio, rand.randint(0, 10000))
+                                                        for prio in priorities))
+                                            for site in sites if rand.random() < 0.6),
+                'activeRunJobByStatus': {'New': rand.randint(0, 100),
+                                         'Running': rand.randint(0, 10000)},
+            },
+            'LocalWQ_INFO': {
+                'possibleJobsPerSite': possibleJobsPerSite,
+                'uniqueJobsPerSite': uniqueJobsPerSite,
+                'workByStatus': [{'status': status,
+                                  'count': rand.randint(0, 1000),
+                                  'sum': rand.randint(0, 1000000)}
+                                 for status in statuses],
+            },
+        }
+        rows.append({'id': agent_url, 'key': agent_url, 'value': value})
+
+    for i in range(n_central):
+        agent_url = 'central_services_%d' % i
+        rows.append({'id': agent_url, 'key': agent_url,
+                     'value': {'agent_url': agent_url, 'status': 'ok',
+                               'timestamp': base_timestamp + rand.randint(0, 3600)}})
+
+    return {'total_rows': len(rows), 'offset': 0, 'rows': rows}
+
+def peak_memory_kb():
+    """Peak memory so far: traced Python allocations if tracemalloc is
+    running, else the process max RSS"""
+    if tracemalloc is not None and tracemalloc.is_tracing():
+        return tracemalloc.get_traced_memory()[1] // 1024
+    if resource is not None:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return 0
+
+class StageTimer(object):
+    """Collect the best time, item count and peak memory per stage"""
+    def __init__(self):
+        self.stages = []
+        self.results = {}
+
+    def run(self, name, func, count_items):
+        if tracemalloc is not None and tracemalloc.is_tracing() and hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        start = time.time()
+        result = func()
+        elapsed = time.time() - start
+        n_items = count_items(result)
+
+        if name not in self.results:
+            self.stages.append(name)
+            self.results[name] = {'seconds': elapsed, 'items': n_items,
+                                  'peak_kb': peak_memory_kb()}
+        else:
+            best = self.results[name]
+            best['seconds'] = min(best['seconds'], elapsed)
+            best['peak_kb'] = max(best['peak_kb'], peak_memory_kb())
+        return result
+
+    def report(self):
+        lines = ['%-28s %10s %10s %14s %12s' % ('stage', 'seconds', 'items', 'items/s', 'peak_kb')]
+        for name in self.stages:
+            res = self.results[name]
+            rate = res['items'] / res['seconds'] if res['seconds'] > 0 else float('inf')
+            lines.append('%-28s %10.4f %10d %14.0f %12d' % (name, res['seconds'], res['items'],
+                                                          rate, res['peak_kb']))
+        return '\n'.join(lines)
+
+def make_notifications(docs, type_):
+    from StompAMQ import StompAMQ
+    amq = StompAMQ(username='bench', password='bench', host_and_ports=[('localhost', 61613)])
+    return [amq._encode(type_, notification['body'])
+            for notification in amq.make_notifications(((doc, None) for doc in docs), type_=type_)]
+
+def run_benchmark(text, repeat=3, serialize=True):
+    timer = StageTimer()
+    n_rows = lambda data: len(data['rows'])
+
+    for _ in range(repeat):
+        raw_data = timer.run('json parse', lambda: json.loads(text), n_rows)
+        timer.run('data_fixup', lambda: post_agentinfo.data_fixup(raw_data) or raw_data, n_rows)
+        _, site_docs, prio_docs = timer.run('process_site_information',
+                                            lambda: post_agentinfo.process_site_information(raw_data),
+                                            lambda res: len(res[1]) + len(res[2]))
+        work_docs = timer.run('process_work_information',
+                              lambda: post_agentinfo.process_work_information(raw_data), len)
+        agent_docs = [r['value'] for r in raw_data['rows']]
+        raw_data = None
+
+        if serialize:
+            for name, docs, type_ in [('agent', agent_docs, 'cms_wmagent_info'),
+                                      ('site', site_docs, 'cms_wmagent_info_sites'),
+                                      ('prio', prio_docs, 'cms_wmagent_info_priorities'),
+                                      ('work', work_docs, 'cms_wmagent_info_work')]:
+                timer.run('serialize (%s)' % name,
+                          lambda: make_notifications(docs, type_), len)
+        agent_docs = site_docs = prio_docs = work_docs = None
+
+        timer.run('process_stream', lambda: post_agentinfo.process_stream(StringIO(text)),
+                  lambda res: sum(len(docs) for docs in res))
+
+    return timer
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument("--agents", default=50, type=int, dest="n_agents",
+                        help="Number of agents [default: %(default)s]")
+    parser.add_argument("--sites", default=300, type=int, dest="n_sites",
+                        help="Number of sites per agent [default: %(default)s]")
+    parser.add_argument("--priorities", default=5, type=int, dest="n_priorities",
+                        help="Number of priorities per site [default: %(default)s]")
+    parser.add_argument("--statuses", default=4, type=int, dest="n_statuses",
+                        help="Number of LocalWQ statuses [default: %(default)s]")
+    parser.add_argument("--seed", default=42, type=int, dest="seed",
+                        help="Random seed [default: %(default)s]")
+    parser.add_argument("--repeat", default=3, type=int, dest="repeat",
+                        help="Repetitions, the best time is reported [default: %(default)s]")
+    parser.add_argument("--no_serialize", action='store_false', dest="serialize",
+                        help="Skip the StompAMQ notification serialization stages")
+    parser.add_argument("--trace_memory", action='store_true', dest="trace_memory",
+                        help="Measure peak memory per stage with tracemalloc (slower)")
+    parser.add_argument("--write", default='', type=str, dest="write",
+                        help="Only write the generated payload to this file, "
+                             "e.g. for post_agentinfo.py --local_file")
+    parser.add_argument("--json", default='', type=str, dest="json_file",
+                        help="Also write the results to this JSON file")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+
+    data = generate_agentinfo(n_agents=args.n_agents, n_sites=args.n_sites,
+                              n_priorities=args.n_priorities, n_statuses=args.n_statuses,
+                              seed=args.seed)
+    text = json.dumps(data)
+    del data
+
+    if args.write:
+        with open(args.write, 'w') as ofile:
+            ofile.write(text)
+        sys.exit(0)
+
+    if args.serialize:
+        try:
+            import stomp
+        except ImportError:
+            logging.error("stomp.py not found, skipping the serialization stages")
+            args.serialize = False
+
+    if args.trace_memory:
+        if tracemalloc is None:
+            logging.error("tracemalloc not available, reporting the process max RSS instead")
+        else:
+            tracemalloc.start()
+
+    print('Payload: %d agents x %d sites x %d priorities x %d statuses, %.1f MB of JSON' % (
+        args.n_agents, args.n_sites, args.n_priorities, args.n_statuses, len(text) / 1e6))
+    timer = run_benchmark(text, repeat=args.repeat, serialize=args.serialize)
+    print(timer.report())
+
+    if args.json_file:
+        with open(args.json_file, 'w') as ofile:
+            json.dump({'parameters': vars(args), 'stages': timer.results}, ofile, indent=2)
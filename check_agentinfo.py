@@ -0,0 +1,242 @@
+#! /usr/bin/env python
+"""
+Consistency checks for post_agentinfo and its helper modules, run on
+synthetic agentInfo payloads (see bench_agentinfo.py):
+
+- the documents of every processing path are identical to the ones
+  of the original, dict based implementation kept here as reference
+- records hash like the dicts they replace, for the delta cache
+- StateStore and NotificationSpool round trips
+"""
+from __future__ import print_function
+
+import os
+import sys
+import copy
+import json
+import shutil
+import logging
+import tempfile
+import traceback
+from argparse import ArgumentParser
+from StringIO import StringIO
+
+import post_agentinfo
+from DocRecords import to_dict
+from StateStore import STATE_BACKENDS, JSONStateStore
+from NotificationSpool import NotificationSpool
+from bench_agentinfo import generate_agentinfo
+
+def reference_data_fixup(raw_data):
+    """data_fixup as originally written"""
+    for doc in raw_data['rows']:
+        doc['value']['version'] = '0.2'
+        for keyname in ['_deleted_conflicts', '_id', '_rev', 'acdc']:
+            doc['value'].pop(keyname, None)
+        try:
+            for status in ["New", "Idle", "Running"]:
+                doc["value"]["WMBS_INFO"].setdefault("activeRunJobByStatus", {}).setdefault(status, 0)
+        except KeyError:
+            pass
+
+def reference_process_data(raw_data):
+    """process_data as originally written, with one dict per document"""
+    site_docs = []
+    prio_docs = []
+    for doc in raw_data['rows']:
+        try:
+            sitePendCountByPrio = doc['value']['WMBS_INFO'].pop('sitePendCountByPrio', [])
+            thresholds          = doc['value']['WMBS_INFO'].pop('thresholds', {})
+            thresholdsGQ2LQ     = doc['value']['WMBS_INFO'].pop('thresholdsGQ2LQ', {})
+            possibleJobsPerSite = doc['value']['LocalWQ_INFO'].pop('possibleJobsPerSite', [])
+            uniqueJobsPerSite   = doc['value']['LocalWQ_INFO'].pop('uniqueJobsPerSite', [])
+        except KeyError:
+            continue
+
+        for site in sorted(thresholds):
+            site_doc = {}
+            site_doc['site_name'] = site
+            site_doc['type'] = "site_info"
+            site_doc['agent_url'] = doc['value']['agent_url']
+            site_doc['timestamp'] = doc['value']['timestamp']
+            site_doc['thresholds'] = thresholds[site]
+            site_doc['state'] = site_doc['thresholds'].pop('state', 'Unknown')
+            site_doc['thresholdsGQ2LQ'] = thresholdsGQ2LQ.get(site, 0)
+            if site in sitePendCountByPrio:
+                for prio, jobs in sitePendCountByPrio[site].iteritems():
+                    prio_docs.append({'site_name': site, 'type': "priority_info",
+                                      'agent_url': doc['value']['agent_url'],
+                                      'timestamp': doc['value']['timestamp'],
+                                      'priority': prio, 'count': jobs})
+
+            site_doc['LocalWQ_INFO'] = {}
+            for status in possibleJobsPerSite.keys():
+                lwq_info = {}
+                for item in possibleJobsPerSite[status]:
+                    if item['site_name'] == site:
+                        lwq_info['possibleJobsPerSite'] = item['Jobs']
+                        lwq_info['NumElems'] = item['NumElems']
+                for item in uniqueJobsPerSite[status]:
+                    if item['site_name'] == site:
+                        lwq_info['uniqueJobsPerSite'] = item['Jobs']
+                site_doc['LocalWQ_INFO'][status] = lwq_info
+            site_docs.append(site_doc)
+
+    work_docs = []
+    for doc in raw_data['rows']:
+        try:
+            workByStatus = doc['value']['LocalWQ_INFO'].pop('workByStatus', [])
+        except KeyError:
+            continue
+        for status_info in workByStatus:
+            work_docs.append({'type': "work_info",
+                              'agent_url': doc['value']['agent_url'],
+                              'timestamp': doc['value']['timestamp'],
+                              'status': status_info['status'],
+                              'count': status_info['count'],
+                              'sum': status_info['sum']})
+
+    return [r['value'] for r in raw_data['rows']], site_docs, prio_docs, work_docs
+
+def dumps(docs):
+    return json.dumps(docs, sort_keys=True, default=to_dict)
+
+def check_equal(name, expected, result):
+    names = ('agent', 'site', 'priority', 'work')
+    for kind, docs, other in zip(names, expected, result):
+        assert len(docs) == len(other), '%s: %d %s docs instead of %d' % (
+            name, len(other), kind, len(docs))
+        assert dumps(docs) == dumps(other), '%s: %s docs differ' % (name, kind)
+
+def check_processing(data):
+    """Every processing path gives the documents of the reference"""
+    raw_data = copy.deepcopy(data)
+    reference_data_fixup(raw_data)
+    expected = reference_process_data(raw_data)
+
+    raw_data = copy.deepcopy(data)
+    post_agentinfo.data_fixup(raw_data)
+    check_equal('process_data', expected, post_agentinfo.process_data(raw_data))
+
+    text = json.dumps(data)
+    check_equal('process_stream', expected, post_agentinfo.process_stream(StringIO(text)))
+    check_equal('process_stream (small chunks)', expected,
+                post_agentinfo.merge_processed_rows(post_agentinfo.process_rows(
+                    post_agentinfo.iter_view_rows(StringIO(text), chunk_size=100))))
+    result = post_agentinfo.process_rows_parallel(copy.deepcopy(data)['rows'],
+                                                  processes=2, min_rows=0)
+    check_equal('process_rows_parallel', expected, result)
+    # The records rebuilt from the workers share their strings again
+    for field, records in (('site_name', result[1]), ('state', result[1]),
+                           ('priority', result[2]), ('status', result[3])):
+        n_objects = len(set(id(record[field]) for record in records))
+        n_values = len(set(record[field] for record in records))
+        assert n_objects == n_values, 'process_rows_parallel: %d %s strings for %d values' % (
+            n_objects, field, n_values)
+
+    # The delta cache keys and hashes must not change with the records
+    raw_data = copy.deepcopy(data)
+    post_agentinfo.data_fixup(raw_data)
+    result = post_agentinfo.process_data(raw_data)
+    for docs, records in zip(expected[1:], result[1:]):
+        for doc, record in zip(docs, records):
+            assert post_agentinfo.delta_key(doc) == post_agentinfo.delta_key(record), 'delta keys differ'
+            assert post_agentinfo.content_hash(doc) == post_agentinfo.content_hash(record), \
+                'content hashes differ for %s' % post_agentinfo.delta_key(doc)
+    return sum(len(docs) for docs in expected)
+
+def check_state_stores(workdir):
+    """Updates survive reopening the store, for all backends"""
+    for backend, store_class in sorted(STATE_BACKENDS.items()):
+        filename = os.path.join(workdir, 'state.%s' % backend)
+        store = store_class(filename)
+        store.update('timestamps', {'a': 1, 'b': 2})
+        store.update('timestamps', {'b': 3})
+        store.update('delta', {'x|y': ['hash', 1.5]})
+        store.close()
+        store = store_class(filename)
+        assert store.load('timestamps') == {'a': 1, 'b': 3}, backend
+        assert store.load('delta') == {'x|y': ['hash', 1.5]}, backend
+        store.close()
+
+    # JSON log: a torn last line is dropped, compaction keeps everything
+    filename = os.path.join(workdir, 'compact.json')
+    store = JSONStateStore(filename, min_compact_bytes=100)
+    store.update('timestamps', {'a': 1})
+    with open(filename + '.log', 'a') as lfile:
+        lfile.write('{"torn": ')
+    store = JSONStateStore(filename, min_compact_bytes=100)
+    assert store.load('timestamps') == {'a': 1}
+    for i in range(20):
+        store.update('timestamps', {'k%d' % i: i})
+    assert os.path.exists(filename), 'the log was never compacted'
+    expected = dict(('k%d' % i, i) for i in range(20))
+    expected['a'] = 1
+    assert JSONStateStore(filename).load('timestamps') == expected
+
+    # JSON log: two processes sharing the store keep each other's updates,
+    # also through a compaction
+    filename = os.path.join(workdir, 'shared.json')
+    store_a = JSONStateStore(filename, min_compact_bytes=100)
+    store_b = JSONStateStore(filename, min_compact_bytes=100)
+    store_a.update('timestamps', {'agentA': 1})
+    store_b.update('timestamps', {'agentB': 2})
+    store_a.update('timestamps', {'agentA': 3})
+    assert JSONStateStore(filename).load('timestamps') == {'agentA': 3, 'agentB': 2}
+    for i in range(20):
+        store_a.update('timestamps', {'agentA': i})
+    assert JSONStateStore(filename).load('timestamps') == {'agentA': 19, 'agentB': 2}
+
+def check_spool(workdir, docs):
+    """Spooled notifications read back as sent, and drain in order"""
+    spool = NotificationSpool(os.path.join(workdir, 'spool'), segment_docs=7)
+    notifications = [{'topic': '/topic/test', 'type': 'cms_wmagent_info_sites',
+                      'body': {'payload': doc, 'metadata': {'id': None, 'uuid': str(i)}}}
+                     for i, doc in enumerate(docs)]
+    assert spool.write(notifications) == len(notifications)
+    expected = json.loads(dumps(notifications))
+    read = [n for path in spool.segments() for n in spool.read(path)]
+    assert read == expected, 'spooled notifications differ'
+
+    # Only the first 10 get sent, the rest stays for the next drain
+    sent = []
+    def send(batch):
+        bodies = [n['body'] for n in batch[:max(0, 10 - len(sent))]]
+        sent.extend(bodies)
+        return bodies
+    assert spool.drain(send) == 10
+    assert spool.drain(lambda batch: [n['body'] for n in batch]) == len(notifications) - 10
+    assert not spool.segments()
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument("--agents", default=10, type=int, dest="n_agents",
+                        help="Number of agents [default: %(default)s]")
+    parser.add_argument("--sites", default=50, type=int, dest="n_sites",
+                        help="Number of sites per agent [default: %(default)s]")
+    parser.add_argument("--seed", default=42, type=int, dest="seed",
+                        help="Random seed [default: %(default)s]")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+
+    data = generate_agentinfo(n_agents=args.n_agents, n_sites=args.n_sites, seed=args.seed)
+    raw_data = copy.deepcopy(data)
+    post_agentinfo.data_fixup(raw_data)
+    site_docs = post_agentinfo.process_data(raw_data)[1][:25]
+
+    workdir = tempfile.mkdtemp(prefix='check_agentinfo.')
+    checks = [('processing', lambda: '%d docs' % check_processing(data)),
+              ('state stores', lambda: check_state_stores(workdir)),
+              ('spool', lambda: check_spool(workdir, site_docs))]
+    failed = 0
+    try:
+        for name, check in checks:
+            try:
+                print('%-14s ok %s' % (name, check() or ''))
+            except Exception:
+                failed += 1
+                print('%-14s FAILED' % name)
+                traceback.print_exc()
+    finally:
+        shutil.rmtree(workdir)
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,122 @@
+#! /usr/bin/env python
+"""
+End-to-end load test: run post_agentinfo.main on synthetic payloads
+against the in-process STOMP broker and Elasticsearch stand-ins
+and report documents per second and cycle latencies
+"""
+from __future__ import print_function
+from __future__ import division
+
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import tempfile
+from argparse import ArgumentParser
+
+import post_agentinfo
+from bench_agentinfo import generate_agentinfo
+from FakeServices import FakeStompBroker, FakeElasticsearch, percentile
+
+def run_load_test(args, extra_args):
+    broker = FakeStompBroker(latency=args.amq_latency,
+                             failure_rate=args.amq_failure_rate,
+                             seed=args.seed).start()
+    elastic = FakeElasticsearch(latency=args.es_latency,
+                                failure_rate=args.es_failure_rate,
+                                reject_rate=args.es_reject_rate,
+                                seed=args.seed).start()
+    workdir = tempfile.mkdtemp(prefix='wmamon_loadtest_')
+    payload_file = os.path.join(workdir, 'agentinfo.json')
+
+    cycle_times = []
+    cycle_docs = []
+    try:
+        for cycle in range(args.cycles):
+            # Same content every cycle, only newer timestamps
+            data = generate_agentinfo(n_agents=args.n_agents, n_sites=args.n_sites,
+                                      n_priorities=args.n_priorities, n_statuses=args.n_statuses,
+                                      seed=args.seed, base_timestamp=1500000000 + 3600 * cycle)
+            with open(payload_file, 'w') as ofile:
+                json.dump(data, ofile)
+            data = None
+
+            pa_args = post_agentinfo.make_parser().parse_args(
+                ['--local_file', payload_file,
+                 '--amq_host', broker.host_and_port,
+                 '--es_host', elastic.host_and_port,
+                 '--cache_file', os.path.join(workdir, 'cache'),
+                 '--spool_dir', os.path.join(workdir, 'spool'),
+                 '--log_dir', workdir] + extra_args)
+
+            amq_docs_before = broker.stats['docs']
+            docs_before = elastic.n_docs()
+            start = time.time()
+            post_agentinfo.main(pa_args)
+            elapsed = time.time() - start
+            n_docs = broker.stats['docs'] - amq_docs_before + elastic.n_docs() - docs_before
+
+            cycle_times.append(elapsed)
+            cycle_docs.append(n_docs)
+            print('cycle %3d: %8d docs in %7.3f s, %10.0f docs/s' % (
+                cycle, n_docs, elapsed, n_docs / elapsed if elapsed else 0))
+    finally:
+        post_agentinfo.flush_cache()
+        broker.stop()
+        elastic.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    total_time = sum(cycle_times)
+    print('')
+    print('Total: %d docs in %.3f s, %.0f docs/s' % (
+        sum(cycle_docs), total_time, sum(cycle_docs) / total_time if total_time else 0))
+    print('Cycle latency: p50 %.3f s, p95 %.3f s, p99 %.3f s, max %.3f s' % (
+        percentile(cycle_times, 0.5), percentile(cycle_times, 0.95),
+        percentile(cycle_times, 0.99), max(cycle_times)))
+    print('Broker: %(connects)d connects, %(frames)d frames, %(docs)d docs, %(bytes)d bytes, '
+          '%(failures)d injected failures' % broker.stats)
+    for endpoint, latencies in sorted(elastic.latencies.items()):
+        print('ES %-12s %6d requests, p50 %.4f s, p99 %.4f s, max %.4f s' % (
+            endpoint, len(latencies), percentile(latencies, 0.5),
+            percentile(latencies, 0.99), max(latencies)))
+
+if __name__ == '__main__':
+    parser = ArgumentParser(
+        description="Any unknown arguments are passed on to post_agentinfo, e.g. --feed_es --workers 8")
+    parser.add_argument("--cycles", default=5, type=int, dest="cycles",
+                        help="Number of post_agentinfo cycles [default: %(default)s]")
+    parser.add_argument("--agents", default=50, type=int, dest="n_agents",
+                        help="Number of agents [default: %(default)s]")
+    parser.add_argument("--sites", default=300, type=int, dest="n_sites",
+                        help="Number of sites per agent [default: %(default)s]")
+    parser.add_argument("--priorities", default=5, type=int, dest="n_priorities",
+                        help="Number of priorities per site [default: %(default)s]")
+    parser.add_argument("--statuses", default=4, type=int, dest="n_statuses",
+                        help="Number of LocalWQ statuses [default: %(default)s]")
+    parser.add_argument("--seed", default=42, type=int, dest="seed",
+                        help="Random seed [default: %(default)s]")
+    parser.add_argument("--amq_latency", default=0., type=float, dest="amq_latency",
+                        help="Broker latency per frame in seconds [default: %(default)s]")
+    parser.add_argument("--amq_failure_rate", default=0., type=float, dest="amq_failure_rate",
+                        help="Fraction of frames rejected by the broker [default: %(default)s]")
+    parser.add_argument("--es_latency", default=0., type=float, dest="es_latency",
+                        help="ES latency per request in seconds [default: %(default)s]")
+    parser.add_argument("--es_failure_rate", default=0., type=float, dest="es_failure_rate",
+                        help="Fraction of ES requests failing with 503 [default: %(default)s]")
+    parser.add_argument("--es_reject_rate", default=0., type=float, dest="es_reject_rate",
+                        help="Fraction of ES bulk items rejected with 429 [default: %(default)s]")
+    parser.add_argument("--log_level", default='ERROR', type=str, dest="log_level",
+                        help="Log level [default: %(default)s]")
+    args, extra_args = parser.parse_known_args()
+    logging.basicConfig(level=getattr(logging, args.log_level.upper()),
+                        format='%(asctime)s : %(name)s:%(levelname)s - %(message)s')
+
+    try:
+        import stomp
+    except ImportError:
+        logging.error("stomp.py not found, post_agentinfo would skip the AMQ submission")
+        sys.exit(1)
+
+    run_load_test(args, extra_args)
@@ -2,14 +2,32 @@
 import sys
 import os
 import json
+import re
 import time
 import socket
+import hashlib
+import gc
+import random
+import signal
 import logging
+import threading
 import urllib
+import urlparse
+import zlib
+import marshal
+import multiprocessing
 from logging.handlers import RotatingFileHandler
 from argparse import ArgumentParser
+from contextlib import contextmanager
+from collections import OrderedDict
+from functools import partial
 from pprint import pformat
 
+from StageMetrics import StageMetrics
+from DocRecords import share, SiteInfo, PriorityInfo, WorkInfo
+
+metrics = StageMetrics() # per-stage timings of the current cycle
+
 def send_email_alert(recipients, subject, message):
     if not recipients:
         return
@@ -36,20 +54,91 @@ def send_email_alert(recipients, subject, message):
     except Exception, e:
         logging.warning("Email notification failed: %s" % str(e))
 
-def load_data_local(filename='agentinfo.json'):
+def load_data_local(filename='agentinfo.json', handler=json.load):
     try:
         with open(filename, 'r') as ifile:
-            return json.load(ifile)
+            return handler(ifile)
     except Exception as msg:
         logging.error('Error loading local file: %s' % str(msg))
         return None
 
-def load_data_from_cmsweb(args):
-    from httplib import HTTPSConnection
-    con = HTTPSConnection("cmsweb.cern.ch",
-                          cert_file=args.cert_file,
-                          key_file=args.key_file)
-    urn = "/couchdb/wmstats/_design/WMStatsErl/_view/agentInfo"
+DEFAULT_WMSTATS = 'https://cmsweb.cern.ch/couchdb/wmstats'
+
+_cmsweb_conns = {} # WMStats url -> connection, kept open between cycles in daemon mode
+_cmsweb_lock = threading.Lock()
+def get_cmsweb_connection(args, url=DEFAULT_WMSTATS):
+    """
+    Return a (possibly reused) HTTP(S) connection for one WMStats url.
+    Each url gets its own connection, also for urls on the same host,
+    since they are fetched concurrently.
+    """
+    scheme, host = urlparse.urlsplit(url)[:2]
+    with _cmsweb_lock:
+        con = _cmsweb_conns.get(url)
+        if con is None or not args.daemon:
+            from httplib import HTTPConnection, HTTPSConnection
+            if scheme == 'https':
+                con = HTTPSConnection(host,
+                                      cert_file=args.cert_file,
+                                      key_file=args.key_file,
+                                      timeout=args.fetch_timeout)
+            else:
+                con = HTTPConnection(host, timeout=args.fetch_timeout)
+            _cmsweb_conns[url] = con
+        return con
+
+def close_cmsweb_connection(url=None, con=None):
+    """
+    Close the connection for one WMStats url, or all of them. With
+    `con`, only if that is still the connection of the url.
+    """
+    with _cmsweb_lock:
+        for key in list(_cmsweb_conns):
+            if url is None or (key == url and con in (None, _cmsweb_conns[key])):
+                _cmsweb_conns.pop(key).close()
+    if con is not None:
+        con.close()
+
+def cmsweb_request(args, url, con, urn, headers):
+    """
+    Send a GET on `con` and return the connection and its response.
+    A kept open connection that the server closed while it was idle
+    fails on first use, so the request is then sent once more on a
+    fresh connection.
+    """
+    from httplib import BadStatusLine
+    reused = con.sock is not None
+    try:
+        con.request("GET", urn, headers=headers)
+        return con, con.getresponse()
+    except socket.timeout:
+        raise
+    except (BadStatusLine, socket.error) as msg:
+        if not reused:
+            raise
+        logging.info("Reconnecting to %s, kept open connection failed: %r", url, msg)
+        close_cmsweb_connection(url, con)
+        con = get_cmsweb_connection(args, url)
+        try:
+            con.request("GET", urn, headers=headers)
+            return con, con.getresponse()
+        except Exception:
+            close_cmsweb_connection(url, con)
+            raise
+
+NOT_MODIFIED = object() # returned by load_data_from_cmsweb on a 304
+
+def load_data_from_cmsweb(args, handler=json.load, url=DEFAULT_WMSTATS, etags=None):
+    """
+    Fetch the agentInfo view of the WMStats database at `url` and pass
+    the response to `handler`. With args.incremental the request is
+    conditional on the ETag of the last submitted fetch, NOT_MODIFIED
+    is returned if it matches, and the new ETag is put in `etags`.
+    """
+    scheme, host, path = urlparse.urlsplit(url)[:3]
+    con = get_cmsweb_connection(args, url)
+    keep_alive = False
+    urn = path.rstrip('/') + "/_design/WMStatsErl/_view/agentInfo"
     params = {"stale": "update_after"}
     headers = {
                 "Content-type": "application/json",
@@ -59,121 +148,280 @@ def load_data_from_cmsweb(args):
 
     try:
         urn = "%s?%s" % (urn, urllib.urlencode(params, doseq=True))
-        con.request("GET", urn, headers=headers)
-        resp = con.getresponse()
+        etag_key = "%s://%s%s" % (scheme, host, urn)
+        etag = load_etag(etag_key) if args.incremental else None
+        if etag:
+            headers["If-None-Match"] = etag
+        con, resp = cmsweb_request(args, url, con, urn, headers)
+        if resp.status == 304:
+            resp.read()
+            keep_alive = args.daemon
+            return NOT_MODIFIED
         if resp.status != 200:
             errorMsg = "Error contacting CMSWEB WMStats\n"
             errorMsg += "Response status: %s\tResponse reason: %s\n" % (resp.status, resp.reason)
             raise Exception(errorMsg)
 
-        return json.load(resp)
+        data = handler(resp)
+        resp.read() # drain whatever the handler left, to reuse the connection
+        keep_alive = args.daemon
+        if args.incremental and etags is not None and resp.getheader("ETag"):
+            etags[etag_key] = resp.getheader("ETag")
+        return data
     except Exception as msg:
-        message = 'Error connecting to CMSWeb: %s' % str(msg)
+        message = 'Error connecting to %s: %s' % (host, str(msg))
         send_email_alert(args.email_alerts,
                          "post_agentinfo connection failure",
                          message)
         logging.error(message)
         return None
     finally:
-        con.close()
+        if not keep_alive:
+            close_cmsweb_connection(url, con)
+
+def merge_rows(row_lists):
+    """
+    Merge view rows from several WMStats instances, keeping the one
+    with the newest timestamp per agent_url, in order of first appearance
+    """
+    merged = OrderedDict()
+    for rows in row_lists:
+        for row in rows:
+            agent_url = row['value'].get('agent_url', row.get('id'))
+            previous = merged.get(agent_url)
+            if previous is None or row['value'].get('timestamp', 0) > previous['value'].get('timestamp', 0):
+                merged[agent_url] = row
+    return list(merged.values())
+
+def load_data_from_endpoints(args, urls):
+    """
+    Fetch the agentInfo view from several WMStats instances at once
+    and merge their rows with `merge_rows`. An endpoint that fails or
+    takes longer than args.fetch_timeout is left out of the merge.
+
+    :return: the merged view, NOT_MODIFIED if no endpoint changed,
+        or None if none could be fetched
+    """
+    from multiprocessing import TimeoutError
+    from multiprocessing.pool import ThreadPool
 
+    def fetch(url):
+        host = urlparse.urlsplit(url)[1]
+        etags = {}
+        start = time.time()
+        def handler(stream):
+            reader = metrics.reader(stream, 'fetch:%s' % host)
+            if args.stream:
+                return list(iter_view_rows(reader))
+            return json.load(reader).get('rows', [])
+        rows = load_data_from_cmsweb(args, handler=handler, url=url, etags=etags)
+        logging.info("Fetched %s rows from %s in %.1f s",
+                     len(rows) if isinstance(rows, list) else 'no', host, time.time() - start)
+        return rows, etags
+
+    pool = ThreadPool(len(urls))
+    deadline = time.time() + args.fetch_timeout
+    pending = [(url, pool.apply_async(fetch, (url,))) for url in urls]
+    row_lists, etags, n_not_modified = [], {}, 0
+    try:
+        for url, async_result in pending:
+            try:
+                rows, url_etags = async_result.get(max(0, deadline - time.time()))
+            except TimeoutError:
+                logging.error("No complete answer from %s within %d s, skipping it", url, args.fetch_timeout)
+                close_cmsweb_connection(url)
+                continue
+            if rows is NOT_MODIFIED:
+                n_not_modified += 1
+            elif rows is not None:
+                row_lists.append(rows)
+                etags.update(url_etags)
+    finally:
+        pool.close() # don't wait for the endpoints that timed out
+
+    _fetched_etags.update(etags)
+    if n_not_modified == len(urls):
+        return NOT_MODIFIED
+    if not row_lists:
+        return None
+    with metrics.timed('merge', docs=sum(len(rows) for rows in row_lists)):
+        return {'rows': merge_rows(row_lists)}
+
+def fixup_row(doc):
+    """Remove some unwanted key and add some possibly missing keys to a single row"""
+    ## Add a version number for this script
+    doc['value']['version'] = '0.2'
+
+    for keyname in ['_deleted_conflicts', '_id', '_rev', 'acdc']:
+        doc['value'].pop(keyname, None)
+    try:
+        # Ensure we always have 'New', 'Idle', 'Running' fields in
+        # WMBS_INFO.activeRunJobByStatus
+        for status in ["New", "Idle", "Running"]:
+            doc["value"]["WMBS_INFO"].setdefault("activeRunJobByStatus", {}).setdefault(status, 0)
+    except KeyError:
+        pass  # only agents have the WMBS_INFO key, not central services
 
 def data_fixup(raw_data):
     """Remove some unwanted key and add some possibly missing keys"""
     for doc in raw_data['rows']:
-        ## Add a version number for this script
-        doc['value']['version'] = '0.2'
+        fixup_row(doc)
 
-        for keyname in ['_deleted_conflicts', '_id', '_rev', 'acdc']:
-            doc['value'].pop(keyname, None)
-        try:
-            # Ensure we always have 'New', 'Idle', 'Running' fields in
-            # WMBS_INFO.activeRunJobByStatus
-            for status in ["New", "Idle", "Running"]:
-                doc["value"]["WMBS_INFO"].setdefault("activeRunJobByStatus", {}).setdefault(status, 0)
-        except KeyError:
-            pass  # only agents have the WMBS_INFO key, not central services
+def index_local_wq(possibleJobsPerSite, uniqueJobsPerSite):
+    """
+    Turn the LocalWQ lists of {'site_name', 'Jobs', 'NumElems'} dicts
+    (one list per status) into a nested site -> status -> info mapping,
+    so that the per-site lookups don't have to rescan the lists.
+
+    As before, the last entry for a given site and status wins.
+    """
+    lwq_index = {}
+    for status in possibleJobsPerSite.keys():
+        for item in possibleJobsPerSite[status]:
+            lwq_info = lwq_index.setdefault(item['site_name'], {}).setdefault(status, {})
+            lwq_info['possibleJobsPerSite'] = item['Jobs']
+            lwq_info['NumElems'] = item['NumElems']
+        for item in uniqueJobsPerSite[status]:
+            lwq_info = lwq_index.setdefault(item['site_name'], {}).setdefault(status, {})
+            lwq_info['uniqueJobsPerSite'] = item['Jobs']
+    return lwq_index
+
+def site_information_from_row(doc):
+    """
+    Split the site-by-site information of a single row into
+    separate site and priority documents
+    """
+    site_docs = []
+    prio_docs = []
+    try:
+        sitePendCountByPrio = doc['value']['WMBS_INFO'].pop('sitePendCountByPrio', [])
+        thresholds          = doc['value']['WMBS_INFO'].pop('thresholds', {})
+        thresholdsGQ2LQ     = doc['value']['WMBS_INFO'].pop('thresholdsGQ2LQ', {})
+        possibleJobsPerSite = doc['value']['LocalWQ_INFO'].pop('possibleJobsPerSite', [])
+        uniqueJobsPerSite   = doc['value']['LocalWQ_INFO'].pop('uniqueJobsPerSite', [])
+    except KeyError as e:
+        logging.debug('Missing key in %s: %s' % (doc['value']['agent_url'], str(e)))
+        return site_docs, prio_docs
+
+    lwq_index = index_local_wq(possibleJobsPerSite, uniqueJobsPerSite)
+
+    agent_url = doc['value']['agent_url']
+    timestamp = doc['value']['timestamp']
+    for site in sorted(thresholds):
+        site_name = share(site)
+        site_thresholds = thresholds[site]
+        state = share(site_thresholds.pop('state', 'Unknown'))
+        if site in sitePendCountByPrio:
+            for prio, jobs in sitePendCountByPrio[site].iteritems():
+                prio_docs.append(PriorityInfo(site_name, agent_url, timestamp, share(prio), jobs))
+
+        site_lwq_info = lwq_index.get(site, {})
+        lwq_info = dict((status, site_lwq_info.get(status, {})) for status in possibleJobsPerSite.keys())
+
+        site_docs.append(SiteInfo(site_name, agent_url, timestamp, state, site_thresholds,
+                                  thresholdsGQ2LQ.get(site, 0), lwq_info))
+
+    return site_docs, prio_docs
 
 def process_site_information(raw_data):
     site_docs = []
     prio_docs = []
     for doc in raw_data['rows']:
-        try:
-            sitePendCountByPrio = doc['value']['WMBS_INFO'].pop('sitePendCountByPrio', [])
-            thresholds          = doc['value']['WMBS_INFO'].pop('thresholds', {})
-            thresholdsGQ2LQ     = doc['value']['WMBS_INFO'].pop('thresholdsGQ2LQ', {})
-            possibleJobsPerSite = doc['value']['LocalWQ_INFO'].pop('possibleJobsPerSite', [])
-            uniqueJobsPerSite   = doc['value']['LocalWQ_INFO'].pop('uniqueJobsPerSite', [])
-        except KeyError as e:
-            logging.debug('Missing key in %s: %s' % (doc['value']['agent_url'], str(e)))
-            continue
-
-        for site in sorted(thresholds):
-            site_doc = {}
-            site_doc['site_name'] = site
-            site_doc['type'] = "site_info"
-            site_doc['agent_url'] = doc['value']['agent_url']
-            site_doc['timestamp'] = doc['value']['timestamp']
-
-            site_doc['thresholds'] = thresholds[site]
-            site_doc['state'] = site_doc['thresholds'].pop('state', 'Unknown')
-            site_doc['thresholdsGQ2LQ'] = thresholdsGQ2LQ.get(site, 0)
-            if site in sitePendCountByPrio:
-                for prio, jobs in sitePendCountByPrio[site].iteritems():
-                    prio_doc = {}
-                    prio_doc['site_name'] = site
-                    prio_doc['type'] = "priority_info"
-                    prio_doc['agent_url'] = doc['value']['agent_url']
-                    prio_doc['timestamp'] = doc['value']['timestamp']
-                    prio_doc['priority'] = prio
-                    prio_doc['count'] = jobs
-                    prio_docs.append(prio_doc)
-
-            site_doc['LocalWQ_INFO'] = {}
-            for status in possibleJobsPerSite.keys():
-                # very inefficient, it would be better if the agent was providing a nested
-                # dictionary key'ed by the site name instead of a list of dicts
-                lwq_info = {}
-                for item in possibleJobsPerSite[status]:
-                    if item['site_name'] == site:
-                        lwq_info['possibleJobsPerSite'] = item['Jobs']
-                        lwq_info['NumElems'] = item['NumElems']
-                for item in uniqueJobsPerSite[status]:
-                    if item['site_name'] == site:
-                        lwq_info['uniqueJobsPerSite'] = item['Jobs']
-                site_doc['LocalWQ_INFO'][status] = lwq_info
-
-            site_docs.append(site_doc)
+        row_site_docs, row_prio_docs = site_information_from_row(doc)
+        site_docs.extend(row_site_docs)
+        prio_docs.extend(row_prio_docs)
 
     return raw_data, site_docs, prio_docs
 
+def add_numbers(total, values):
+    """Add the numbers in the (nested) dict `values` into `total`"""
+    for key, value in values.iteritems():
+        if isinstance(value, dict):
+            subtotal = total.get(key)
+            if not isinstance(subtotal, dict):
+                subtotal = total[key] = {}
+            add_numbers(subtotal, value)
+        elif isinstance(value, (int, long, float)) and not isinstance(value, bool):
+            total[key] = total.get(key, 0) + value
+
+def rollup_site_information(site_docs, prio_docs, timestamp=None):
+    """
+    Aggregate the site and priority docs of all agents into one doc
+    per site, summing the thresholds, the LocalWQ possible/unique jobs
+    by status and the pending jobs by priority, and counting the site
+    states reported by the agents. Each cycle's rollup gets its own
+    `timestamp` (default: now), with the newest contributing agent
+    report in 'latest_report'.
+    """
+    if timestamp is None:
+        timestamp = int(time.time())
+    rollup = {}
+    for doc in site_docs:
+        site = rollup.get(doc['site_name'])
+        if site is None:
+            site = rollup[doc['site_name']] = {
+                'site_name': doc['site_name'],
+                'type': "site_rollup",
+                'timestamp': timestamp,
+                'latest_report': 0,
+                'n_agents': 0,
+                'states': {},
+                'thresholds': {},
+                'thresholdsGQ2LQ': 0,
+                'LocalWQ_INFO': {},
+                'pending_by_priority': {},
+            }
+        site['latest_report'] = max(site['latest_report'], doc['timestamp'])
+        site['n_agents'] += 1
+        site['states'][doc['state']] = site['states'].get(doc['state'], 0) + 1
+        add_numbers(site['thresholds'], doc['thresholds'])
+        add_numbers(site, {'thresholdsGQ2LQ': doc['thresholdsGQ2LQ']})
+        add_numbers(site['LocalWQ_INFO'], doc['LocalWQ_INFO'])
+
+    for doc in prio_docs:
+        pending = rollup[doc['site_name']]['pending_by_priority']
+        pending[doc['priority']] = pending.get(doc['priority'], 0) + doc['count']
+
+    rollup_docs = []
+    for site_name in sorted(rollup):
+        site = rollup[site_name]
+        site['pending_by_priority'] = [{'priority': prio, 'count': count}
+                                       for prio, count in sorted(site['pending_by_priority'].items())]
+        rollup_docs.append(site)
+    return rollup_docs
+
+def work_information_from_row(doc):
+    """Split the workByStatus metric of a single row into separate documents"""
+    work_docs = []
+    try:
+        workByStatus = doc['value']['LocalWQ_INFO'].pop('workByStatus', [])
+    except KeyError as e:
+        logging.debug('Missing key in %s: %s' % (doc['value']['agent_url'], str(e)))
+        return work_docs
+
+    for status_info in workByStatus:
+        work_docs.append(WorkInfo(doc['value']['agent_url'], doc['value']['timestamp'],
+                                  share(status_info['status']), status_info['count'], status_info['sum']))
+
+    return work_docs
+
 def process_work_information(raw_data):
     work_docs = []
     for doc in raw_data['rows']:
-        try:
-            workByStatus = doc['value']['LocalWQ_INFO'].pop('workByStatus', [])
-        except KeyError as e:
-            logging.debug('Missing key in %s: %s' % (doc['value']['agent_url'], str(e)))
-            continue
-
-        for status_info in workByStatus:
-            work_doc = {}
-            work_doc['type'] = "work_info"
-            work_doc['agent_url'] = doc['value']['agent_url']
-            work_doc['timestamp'] = doc['value']['timestamp']
-            work_doc['status'] = status_info['status']
-            work_doc['count']  = status_info['count']
-            work_doc['sum']    = status_info['sum']
-            work_docs.append(work_doc)
+        work_docs.extend(work_information_from_row(doc))
 
     return work_docs
 
 def process_data(raw_data):
     ## Transform the site-by-site information into separate documents
+    start = time.time()
     raw_data, site_docs, prio_docs = process_site_information(raw_data)
+    metrics.add('extract_sites', seconds=time.time() - start, docs=len(site_docs) + len(prio_docs))
 
     ## Transform the workByStatus metric into separate documents, one by status by node
+    start = time.time()
     work_docs = process_work_information(raw_data)
+    metrics.add('extract_work', seconds=time.time() - start, docs=len(work_docs))
 
     try:
         return [r['value'] for r in raw_data['rows']], site_docs, prio_docs, work_docs
@@ -181,6 +429,162 @@ def process_data(raw_data):
         logging.error('Error processing data: %s' % str(msg))
         return None
 
+_ROW_SEPARATORS = re.compile(r'[ \t\r\n,]*')
+def iter_view_rows(stream, chunk_size=64*1024):
+    """
+    Incrementally parse a CouchDB view response from a file-like
+    object, yielding the entries of its 'rows' array one at a time
+    instead of building the whole document tree in memory.
+    """
+    decoder = json.JSONDecoder()
+    buf = ''
+    eof = False
+
+    # Skip ahead to the opening bracket of the rows array
+    while True:
+        pos = buf.find('"rows"')
+        if pos >= 0 and buf.find('[', pos) >= 0:
+            buf = buf[buf.find('[', pos)+1:]
+            break
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            raise ValueError("No 'rows' array found in view response")
+        buf += chunk
+
+    pos = 0
+    while True:
+        pos = _ROW_SEPARATORS.match(buf, pos).end()
+        if buf.startswith(']', pos):
+            return
+        if pos < len(buf):
+            try:
+                row, pos = decoder.raw_decode(buf, pos)
+            except ValueError:
+                if eof:
+                    raise
+            else:
+                yield row
+                continue
+        elif eof:
+            raise ValueError("View response ended before the end of the rows array")
+
+        # Read four times the partial row before decoding it again, so
+        # that the failed decodes of a large row add up to a fraction of
+        # its size, instead of one decode of the whole row per chunk
+        chunks = [buf[pos:]]
+        want = max(chunk_size, 4 * len(chunks[0]))
+        while want > 0:
+            chunk = stream.read(want)
+            if not chunk:
+                eof = True
+                break
+            chunks.append(chunk)
+            want -= len(chunk)
+        buf = ''.join(chunks)
+        pos = 0
+
+def process_rows(rows):
+    """
+    Generator pipeline: run every row through the fixup and the
+    site/priority/work extraction as soon as it is parsed, yielding
+    (agent_doc, site_docs, prio_docs, work_docs) per row
+    """
+    for doc in rows:
+        start = time.time()
+        fixup_row(doc)
+        fixed = time.time()
+        site_docs, prio_docs = site_information_from_row(doc)
+        sites_done = time.time()
+        work_docs = work_information_from_row(doc)
+        metrics.add('fixup', seconds=fixed - start, docs=1)
+        metrics.add('extract_sites', seconds=sites_done - fixed, docs=len(site_docs) + len(prio_docs))
+        metrics.add('extract_work', seconds=time.time() - sites_done, docs=len(work_docs))
+        yield doc['value'], site_docs, prio_docs, work_docs
+
+def process_stream(stream, row_filter=None):
+    """
+    Streaming equivalent of json.load, data_fixup and process_data.
+    Only one raw row is ever held in memory at a time. Rows for which
+    `row_filter` returns False are dropped before any processing.
+    """
+    rows = iter_view_rows(stream)
+    if row_filter is not None:
+        rows = (row for row in rows if row_filter(row))
+    return merge_processed_rows(process_rows(rows))
+
+def merge_processed_rows(processed_rows):
+    """Concatenate the (agent_doc, site_docs, prio_docs, work_docs) of each row"""
+    processed_docs, site_docs, prio_docs, work_docs = [], [], [], []
+    for agent_doc, row_site_docs, row_prio_docs, row_work_docs in processed_rows:
+        processed_docs.append(agent_doc)
+        site_docs.extend(row_site_docs)
+        prio_docs.extend(row_prio_docs)
+        work_docs.extend(row_work_docs)
+    return processed_docs, site_docs, prio_docs, work_docs
+
+@contextmanager
+def gc_paused():
+    """
+    Suspend the cyclic garbage collector, which otherwise keeps
+    rescanning the millions of dicts and lists built while parsing
+    and processing the view. Those hold no reference cycles, so
+    reference counting alone frees them.
+    """
+    was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if was_enabled:
+            gc.enable()
+
+_shard_rows = None # the rows process_shard works on, inherited by the forked workers
+def process_shard(indices):
+    """
+    Pool worker: process the rows at `indices`, returning the marshalled
+    (index, processed row) pairs, several times cheaper than pickling them
+    """
+    return marshal.dumps([(i, (agent_doc,
+                               [d.astuple() for d in site_docs],
+                               [d.astuple() for d in prio_docs],
+                               [d.astuple() for d in work_docs]))
+                          for i, (agent_doc, site_docs, prio_docs, work_docs)
+                          in zip(indices, process_rows(_shard_rows[i] for i in indices))])
+
+def process_rows_parallel(rows, processes=2, min_rows=100):
+    """
+    Run the fused per-row fixup and extraction of `process_rows` on a
+    pool of forked worker processes, with the rows sharded by agent_url.
+    The workers inherit the rows when forked, so only the results are
+    sent back, marshalled. The output is merged back in row order, identical to the
+    serial path, which is used for fewer than `min_rows` rows.
+    """
+    global _shard_rows
+    if processes <= 1 or len(rows) < min_rows:
+        return merge_processed_rows(process_rows(rows))
+
+    shards = [[] for _ in range(processes)]
+    for i, row in enumerate(rows):
+        agent_url = row['value'].get('agent_url', '').encode('utf-8')
+        shards[(zlib.crc32(agent_url) & 0xffffffff) % processes].append(i)
+
+    from multiprocessing import Pool
+    _shard_rows = rows
+    pool = Pool(processes)
+    try:
+        processed_rows = [None] * len(rows)
+        for shard in pool.imap_unordered(process_shard, [shard for shard in shards if shard]):
+            for i, (agent_doc, site_docs, prio_docs, work_docs) in marshal.loads(shard):
+                processed_rows[i] = (agent_doc,
+                                     [SiteInfo.fromtuple(values) for values in site_docs],
+                                     [PriorityInfo.fromtuple(values) for values in prio_docs],
+                                     [WorkInfo.fromtuple(values) for values in work_docs])
+    finally:
+        pool.terminate()
+        pool.join()
+        _shard_rows = None
+    return merge_processed_rows(processed_rows)
+
 def set_up_logging(args):
     """Configure root logger with rotating file handler"""
     logger = logging.getLogger()
@@ -200,22 +604,27 @@ def set_up_logging(args):
 
     logger.addHandler(filehandler)
 
+DEFAULT_CACHE_FILES = {
+    'json'   : os.path.expanduser('~/wmamon_es/.last_processed.json'),
+    'sqlite' : os.path.expanduser('~/wmamon_es/.last_processed.sqlite'),
+}
+
+_state_store = None
 _doc_cache = None # agent_url -> last timestamp to be processed
-_doc_cache_filename = None
-def load_cache(filename='/home/stiegerb/wmamon_es/.last_processed.json'):
-    global _doc_cache, _doc_cache_filename
-    _doc_cache_filename = filename
-    if not _doc_cache:
-        try:
-            with open(filename, 'r') as cfile:
-                logging.debug("Loading cache file")
-                _doc_cache = json.load(cfile)
-        except ValueError: # File is empty?!
-            logging.debug("Cache file is empty")
-            _doc_cache = {}
-        except IOError: # File doesn't exist (yet)
-            logging.debug("Cache file not found")
-            _doc_cache = {}
+def load_cache(filename=None, backend='json'):
+    """
+    Open the state store (once) and load the timestamp cache from it
+
+    :param filename: The state file, see DEFAULT_CACHE_FILES
+    :param backend: 'json' or 'sqlite', see StateStore
+    """
+    global _doc_cache, _state_store
+    if _state_store is None:
+        from StateStore import make_state_store
+        _state_store = make_state_store(backend, filename or DEFAULT_CACHE_FILES[backend])
+    if _doc_cache is None:
+        logging.debug("Loading cache")
+        _doc_cache = _state_store.load('timestamps')
 
     return True
 
@@ -226,49 +635,178 @@ def check_timestamp_in_cache(doc):
 
     Always returns True if that agent is not already in the cache
     """
-    if not _doc_cache: load_cache()
+    if _doc_cache is None: load_cache()
     return doc['timestamp'] > _doc_cache.get(doc['agent_url'], 0)
 
+def flush_cache():
+    """Write any pending state and close the state store"""
+    global _state_store
+    flush_delta_cache()
+    if _state_store is not None:
+        _state_store.close()
+    _state_store = None
+
 def update_cache(docs):
     """
-    Update the cache file with the timestamps from these docs
+    Update the cache with the timestamps from these docs,
+    only the changed agents are written to the state store
     """
-    if not _doc_cache: load_cache()
-    _doc_cache.update({(d['agent_url'],d['timestamp']) for d in docs})
+    if _doc_cache is None: load_cache()
+    changes = dict((d['agent_url'], d['timestamp']) for d in docs)
+    _doc_cache.update(changes)
 
-    with open(_doc_cache_filename, 'w') as cfile:
-        logging.debug("Updating cache file with %d entries" % len(docs))
-        json.dump(_doc_cache, cfile, indent=2)
+    logging.debug("Updating cache with %d entries" % len(changes))
+    _state_store.update('timestamps', changes)
 
+_fetched_etags = {} # url -> ETag of this cycle's fetches, saved once they were submitted
+def load_etag(url):
+    """The ETag of the last submitted fetch of `url`, if any"""
+    if _state_store is None: load_cache()
+    return _state_store.load('etags').get(url)
+
+def save_fetched_etags():
+    """Make the next incremental fetches conditional on this cycle's ETags"""
+    _state_store.update('etags', _fetched_etags)
+    _fetched_etags.clear()
+
+def is_new_row(doc):
+    """Whether a raw view row reports a newer timestamp than the cache"""
+    return check_timestamp_in_cache(doc['value'])
+
+# Fields identifying a derived document within one agent report, per doc type
+DELTA_KEYS = {
+    'site_info'     : ('site_name',),
+    'priority_info' : ('site_name', 'priority'),
+    'work_info'     : ('status',),
+    'site_rollup'   : ('site_name',),
+}
+
+_delta_cache = None # "type|agent_url|key" -> [content hash, last time sent]
+_delta_dirty = {} # entries of _delta_cache not yet written to the state store
+def load_delta_cache():
+    """Load the delta cache from the state store"""
+    global _delta_cache
+    if _delta_cache is None:
+        if _state_store is None: load_cache()
+        _delta_cache = _state_store.load('delta')
+    return _delta_cache
+
+def flush_delta_cache():
+    """Write the changed delta cache entries to the state store"""
+    global _delta_dirty
+    if not _delta_dirty or _state_store is None:
+        return
+    changes, _delta_dirty = _delta_dirty, {}
+    _state_store.update('delta', changes)
+
+def delta_key(doc):
+    fields = [doc['type'], doc.get('agent_url', '')]
+    fields.extend(u'%s' % doc.get(k) for k in DELTA_KEYS.get(doc['type'], ()))
+    return u'|'.join(fields)
+
+def content_hash(doc):
+    """Hash of the doc content, ignoring its timestamp"""
+    content = dict((k, v) for k, v in doc.iteritems() if k != 'timestamp')
+    return hashlib.sha1(json.dumps(content, sort_keys=True)).hexdigest()
+
+def filter_unchanged(docs, full_refresh=0):
+    """
+    Drop the docs whose content is identical to what was last sent
+    for the same agent, doc type and site/priority/status, unless
+    that was more than `full_refresh` minutes ago (0: never resend)
+    """
+    delta_cache = load_delta_cache()
+    now = time.time()
+    changed = []
+    for doc in docs:
+        last_hash, last_sent = delta_cache.get(delta_key(doc), (None, 0))
+        if (last_hash != content_hash(doc) or
+            (full_refresh and now - last_sent >= full_refresh * 60)):
+            changed.append(doc)
+    return changed
+
+def update_delta_cache(docs):
+    """Record the content of these docs as last sent"""
+    delta_cache = load_delta_cache()
+    now = time.time()
+    for doc in docs:
+        key = delta_key(doc)
+        delta_cache[key] = _delta_dirty[key] = [content_hash(doc), now]
+
+def submit_changed_to_cern_amq(data, args, type_, stomp_interface=None):
+    """
+    Submit only the docs that changed since they were last sent
+    (all of them without --delta) and remember what was sent
+    """
+    if not args.delta:
+        return submit_to_cern_amq(data, args=args, type_=type_, stomp_interface=stomp_interface)
+
+    with metrics.timed('delta_filter:%s' % type_, docs=len(data)):
+        changed = filter_unchanged(data, full_refresh=args.full_refresh)
+    logging.info("Skipping %d unchanged of %d docs of type %s", len(data) - len(changed), len(data), type_)
+    spooled = []
+    sent_data = submit_to_cern_amq(changed, args=args, type_=type_, stomp_interface=stomp_interface,
+                                   spooled=spooled)
+    update_delta_cache([b['payload'] for b in sent_data + spooled])
+    return sent_data
+
+_es_interfaces = {} # (index_name, doc_type) -> WMAMonElasticInterface, in daemon mode
 def submit_to_elastic(data, args, index_name='wmamon-dummy', doc_type='agent_info'):
     if args.dry_run:
         logging.warning("Dry-run injection to UNL ES, using index_name %s and doc_type %s", index_name, doc_type)
         logging.debug("Data to be injected is:\n%s", pformat(data))
         return
 
-    from WMAMonElasticInterface import WMAMonElasticInterface
-    es_interface = WMAMonElasticInterface(hosts=['localhost:9200'],
-                                          index_name=index_name,
-                                          doc_type=doc_type,
-                                          recreate=args.recreate_index)
-    if not es_interface.connected: return -2
+    es_interface = _es_interfaces.get((index_name, doc_type)) if args.daemon else None
+    if es_interface is None:
+        from WMAMonElasticInterface import WMAMonElasticInterface
+        es_interface = WMAMonElasticInterface(hosts=[args.es_host],
+                                              index_name=index_name,
+                                              doc_type=doc_type,
+                                              recreate=args.recreate_index,
+                                              bulk_threads=args.es_threads,
+                                              chunk_size=args.es_chunk_size,
+                                              max_chunk_bytes=args.es_chunk_bytes,
+                                              max_retries=args.es_max_retries,
+                                              index_period=args.index_period,
+                                              pool_maxsize=args.es_pool_size,
+                                              timeout=args.es_timeout,
+                                              keep_alive=args.es_keep_alive)
+        if not es_interface.connected: return -2
+        if args.daemon:
+            _es_interfaces[(index_name, doc_type)] = es_interface
 
-    res = es_interface.bulk_inject_from_list_checked(data)
+    start = time.time()
+    res = es_interface.bulk_inject_from_list_checked(data, dedup=args.es_dedup)
+    metrics.add('es_inject:%s' % index_name, seconds=time.time() - start,
+                docs=res[0] if res else 0)
+    if args.index_retention:
+        es_interface.delete_old_indices(args.index_retention)
     # res = es_interface.bulk_inject_from_list(data)
 
-def submit_to_cern_amq(data, args, type_='cms_wmagent_info'):
+def parse_host_and_port(host_and_port):
+    """'host:port' -> ('host', port)"""
+    host, port = host_and_port.rsplit(':', 1)
+    return (host, int(port))
+
+_stomp_interface = None # shared by all submissions of a run, kept connected between cycles in daemon mode
+def make_stomp_interface(args):
+    """
+    Build the StompAMQ interface to CERN MONIT, or None in dry-run mode
+    or if stomp.py is not available. The same interface is returned
+    until `close_stomp_interface`.
+    """
+    global _stomp_interface
     if args.dry_run:
-        logging.warning("Dry-run injection to MONIT IT, using type_ %s", type_)
-        logging.debug("Data to be injected is:")
-        for doc in data:
-            logging.debug("%s", pformat(doc))
-        return []
+        return None
+    if _stomp_interface is not None:
+        return _stomp_interface
 
     try:
         import stomp
     except ImportError as e:
         logging.warning("stomp.py not found, skipping submission to CERN/AMQ")
-        return []
+        return None
     from StompAMQ import StompAMQ
     StompAMQ._version = '0.1.2'
 
@@ -278,75 +816,434 @@ def submit_to_cern_amq(data, args, type_='cms_wmagent_info'):
     except IOError:
         username = args.username
         password = args.password
+
+    spool = None
+    if args.spool_dir:
+        from NotificationSpool import NotificationSpool
+        spool = NotificationSpool(os.path.expanduser(args.spool_dir),
+                                  max_bytes=args.spool_max_mb * 1024 * 1024,
+                                  max_age=args.spool_max_age * 3600)
+    limiter = None
+    if args.amq_max_rate or args.amq_max_bytes_rate:
+        from RateLimiter import AdaptiveRateLimiter
+        limiter = AdaptiveRateLimiter(msgs_per_sec=args.amq_max_rate,
+                                      bytes_per_sec=args.amq_max_bytes_rate,
+                                      target_latency=args.amq_target_latency)
     stomp_interface = StompAMQ(username=username,
                                password=password,
-                               host_and_ports=[('dashb-mb.cern.ch', 61113)])
+                               host_and_ports=[parse_host_and_port(args.amq_host)],
+                               receipts=args.amq_receipts,
+                               window=args.amq_window,
+                               batch_size=args.amq_batch_size,
+                               batch_bytes=args.amq_batch_bytes,
+                               spool=spool,
+                               limiter=limiter,
+                               heartbeat=args.amq_heartbeat)
+    _stomp_interface = stomp_interface
+    return stomp_interface
+
+def close_stomp_interface():
+    """Disconnect and forget the interface of `make_stomp_interface`"""
+    global _stomp_interface
+    if _stomp_interface is not None:
+        stomp_interface, _stomp_interface = _stomp_interface, None
+        stomp_interface.disconnect()
+
+def submit_to_cern_amq(data, args, type_='cms_wmagent_info', stomp_interface=None, spooled=None):
+    """
+    Send docs to CERN AMQ, see StompAMQ.send for `spooled`
+
+    :return: the bodies of the notifications sent
+    """
+    if args.dry_run:
+        logging.warning("Dry-run injection to MONIT IT, using type_ %s", type_)
+        logging.debug("Data to be injected is:")
+        for doc in data:
+            logging.debug("%s", pformat(doc))
+        return []
 
-    list_data = []
-    for doc in data:
-        id_ = doc.pop("_id", None)
-        list_data.append(stomp_interface.make_notification(payload=doc,
-                                                           id_=id_,
-                                                           type_=type_))
+    stomp_interface = stomp_interface or make_stomp_interface(args)
+    if stomp_interface is None:
+        return []
 
-    sent_data = stomp_interface.send(list_data)
+    # Notifications are built lazily, as the sender consumes them
+    payloads = ((doc, doc.pop("_id", None) if isinstance(doc, dict) else None) for doc in data)
+    serialize_seconds = stomp_interface.serialize_seconds[type_]
+    sent_bytes = stomp_interface.sent_bytes[type_]
+    throttle_seconds = stomp_interface.throttle_seconds[type_]
+    start = time.time()
+    sent_data = stomp_interface.send(stomp_interface.make_notifications(payloads, type_=type_),
+                                     spooled=spooled)
+    serialize_seconds = stomp_interface.serialize_seconds[type_] - serialize_seconds
+    throttle_seconds = stomp_interface.throttle_seconds[type_] - throttle_seconds
+    metrics.add('serialize:%s' % type_, seconds=serialize_seconds, docs=len(sent_data))
+    if args.amq_max_rate or args.amq_max_bytes_rate:
+        metrics.add('amq_throttle:%s' % type_, seconds=throttle_seconds)
+    metrics.add('amq_send:%s' % type_, seconds=time.time() - start - serialize_seconds - throttle_seconds,
+                docs=len(sent_data), bytes_=stomp_interface.sent_bytes[type_] - sent_bytes)
     return sent_data
 
 
-def main(args):
+def submit_new_data(new_data, args, stomp_interface=None):
+    """
+    Submit new agent docs to CERN AMQ and advance the cache only
+    for the docs that were actually sent, or spooled to be sent by
+    the next drain
+    """
+    spooled = []
+    sent_data = submit_to_cern_amq(new_data, args=args, stomp_interface=stomp_interface,
+                                   spooled=spooled)
+    update_cache([b['payload'] for b in sent_data + spooled])
+    return sent_data
+
+def run_sinks(sinks, workers=1):
+    """
+    Run a list of (name, callable) submissions, concurrently on a
+    thread pool if workers > 1.
+
+    :return: a dict of name -> (result, exception or None)
+    """
+    results = {}
+    if workers <= 1:
+        for name, func in sinks:
+            try:
+                results[name] = (func(), None)
+            except Exception as e:
+                logging.exception("Error in %s submission", name)
+                results[name] = (None, e)
+        return results
+
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(min(workers, len(sinks)) or 1)
+    try:
+        if _profiler is not None:
+            sinks = [(name, _profiler.wrap(func)) for name, func in sinks]
+        pending = [(name, pool.apply_async(func)) for name, func in sinks]
+        for name, async_result in pending:
+            try:
+                results[name] = (async_result.get(), None)
+            except Exception as e:
+                logging.error("Error in %s submission: %s", name, str(e))
+                results[name] = (None, e)
+    finally:
+        pool.close()
+        pool.join()
+    return results
+
+def load_and_process_data(args):
+    """
+    Load the agentInfo view, either from a local file or from one or
+    more WMStats instances, and split it into agent, site, priority
+    and work documents
+    """
+    urls = list(OrderedDict.fromkeys(args.wmstats or [DEFAULT_WMSTATS]))
+    if not args.local_file and len(urls) > 1:
+        data = load_data_from_endpoints(args, urls)
+        if not data or data is NOT_MODIFIED:
+            return data
+        return process_raw_data(data, args)
+
+    if args.stream:
+        parse = partial(process_stream, row_filter=is_new_row if args.incremental else None)
+    else:
+        parse = json.load
+
+    handler_seconds = []
+    def handler(stream):
+        # Reads count as 'fetch', fixup and extraction (with --stream)
+        # have their own stages, the rest is 'parse'
+        inner_stages = ('fetch', 'fixup', 'extract_sites', 'extract_work')
+        inner_seconds = metrics.seconds(*inner_stages)
+        start = time.time()
+        result = parse(metrics.reader(stream, 'fetch'))
+        handler_seconds.append(time.time() - start)
+        n_rows = len(result[0]) if args.stream else len(result.get('rows', []))
+        metrics.add('parse', seconds=handler_seconds[0] - (metrics.seconds(*inner_stages) - inner_seconds),
+                    docs=n_rows)
+        return result
+
+    start = time.time()
     if args.local_file:
-        raw_data = load_data_local(args.local_file)
+        data = load_data_local(args.local_file, handler=handler)
     else:
-        raw_data = load_data_from_cmsweb(args)
+        data = load_data_from_cmsweb(args, handler=handler, url=urls[0], etags=_fetched_etags)
+    # Connecting and waiting for the response is part of the fetch
+    metrics.add('fetch', seconds=time.time() - start - sum(handler_seconds))
 
-    if not raw_data:
-        logging.error("Failed to load data; aborting.")
+    if not data or data is NOT_MODIFIED or args.stream:
+        return data
+    return process_raw_data(data, args)
+
+def process_raw_data(data, args):
+    """
+    data_fixup and process_data, or process_rows_parallel with
+    args.processes > 1, on the new rows only with args.incremental
+    """
+    if args.incremental:
+        data['rows'] = [row for row in data['rows'] if is_new_row(row)]
+    processes = min(args.processes, multiprocessing.cpu_count())
+    if processes > 1:
+        with metrics.timed('process_parallel', docs=len(data['rows'])):
+            return process_rows_parallel(data['rows'], processes=processes,
+                                         min_rows=args.parallel_min_rows)
+    with metrics.timed('fixup', docs=len(data['rows'])):
+        data_fixup(data)
+    return process_data(data)
+
+def submit_selfmon(args, stomp_interface=None):
+    """Send the stage metrics of this cycle as a cms_wmagent_info_selfmon doc"""
+    summary = metrics.as_dict()
+    doc = {
+        'host': socket.gethostname(),
+        'timestamp': summary['timestamp'],
+        'total_seconds': summary['total_seconds'],
+        'stages': [dict(counts, stage=name) for name, counts in summary['stages'].items()],
+    }
+    return submit_to_cern_amq([doc], args=args, type_='cms_wmagent_info_selfmon',
+                              stomp_interface=stomp_interface)
+
+_profiler = None # RunProfiler of the current cycle, if it is sampled
+def main(args):
+    """
+    Run one collection cycle, then write out its stage metrics
+    and send them to CERN AMQ, if requested, over the connection of
+    the cycle. A fraction args.profile of the cycles is profiled, see
+    RunProfiler.
+    """
+    global _profiler
+    metrics.reset()
+    if args.profile and random.random() < args.profile:
+        from RunProfiler import RunProfiler
+        _profiler = RunProfiler(args.log_dir).start()
+    try:
+        return run_cycle(args)
+    finally:
+        if _profiler is not None:
+            profiler, _profiler = _profiler, None
+            try:
+                profiler.stop()
+            except Exception:
+                logging.exception("Failed to write the profile")
+        if args.selfmon:
+            try:
+                submit_selfmon(args, stomp_interface=_stomp_interface)
+            except Exception as e:
+                logging.error("Submission of the self-monitoring doc failed: %s", str(e))
+        if not args.daemon:
+            close_stomp_interface()
+        if args.metrics_file:
+            metrics.write(args.metrics_file, fmt=args.metrics_format)
+
+def drain_spool(args):
+    """
+    Send the spooled notifications in a cycle that has nothing new to
+    send. Their docs are already in the caches, only the spool has them.
+    """
+    stomp_interface = make_stomp_interface(args)
+    if stomp_interface is None or not stomp_interface.has_spooled():
         return 0
+    # A new connection drains the spool by itself
+    if stomp_interface.connect() and stomp_interface.has_spooled():
+        return stomp_interface.drain_spool()
+    return 0
 
-    data_fixup(raw_data)
+def run_cycle(args):
+    load_cache(args.cache_file, backend=args.state_backend)
+    _fetched_etags.clear()
+    with gc_paused():
+        result = load_and_process_data(args)
+    if result is NOT_MODIFIED:
+        logging.warning("agentInfo view not modified since the last run")
+        drain_spool(args)
+        return 0
+    if not result:
+        logging.error("Failed to load data; aborting.")
+        return 0
 
-    processed_data, site_data, prio_data, work_data = process_data(raw_data)
-    if not processed_data: return -1
+    processed_data, site_data, prio_data, work_data = result
+    if not processed_data and not args.incremental: return -1
 
-    # Submit to CERN MONIT
+    # Submit to CERN MONIT, over a single connection for all streams
     new_data = [d for d in processed_data if check_timestamp_in_cache(d)]
     if not new_data:
         logging.warning("No new documents found")
+        save_fetched_etags()
+        drain_spool(args)
         return 0
-    sent_data = submit_to_cern_amq(new_data, args=args)
-    update_cache([b['payload'] for b in sent_data])
-    site_data_sent = submit_to_cern_amq(site_data, args=args, type_='cms_wmagent_info_sites')
-    prio_data_sent = submit_to_cern_amq(prio_data, args=args, type_='cms_wmagent_info_priorities')
-    work_data_sent = submit_to_cern_amq(work_data, args=args, type_='cms_wmagent_info_work')
+    stomp_interface = make_stomp_interface(args)
+    if stomp_interface is not None:
+        stomp_interface.connect()
 
-    logging.warning("Summary of CERN AMQ injection:")
-    logging.warning("  Documents submitted for new data: %d", len(sent_data))
-    logging.warning("  Documents submitted for site info: %d", len(site_data_sent))
-    logging.warning("  Documents submitted for prio info: %d", len(prio_data_sent))
-    logging.warning("  Documents submitted for work info: %d", len(work_data_sent))
+    rollup_data = []
+    if args.site_rollup:
+        if args.incremental:
+            logging.warning("No site rollup with --incremental, it would only cover the updated agents")
+        else:
+            with metrics.timed('site_rollup', docs=len(site_data)):
+                rollup_data = rollup_site_information(site_data, prio_data)
+
+    amq_sinks = [
+        ('new data', partial(submit_new_data, new_data, args=args,
+                             stomp_interface=stomp_interface)),
+        ('site info', partial(submit_changed_to_cern_amq, site_data, args=args,
+                              type_='cms_wmagent_info_sites',
+                              stomp_interface=stomp_interface)),
+        ('prio info', partial(submit_changed_to_cern_amq, prio_data, args=args,
+                              type_='cms_wmagent_info_priorities',
+                              stomp_interface=stomp_interface)),
+        ('work info', partial(submit_changed_to_cern_amq, work_data, args=args,
+                              type_='cms_wmagent_info_work',
+                              stomp_interface=stomp_interface)),
+    ]
+    if rollup_data:
+        amq_sinks.append(('site rollup', partial(submit_changed_to_cern_amq, rollup_data, args=args,
+                                                 type_='cms_wmagent_info_site_rollup',
+                                                 stomp_interface=stomp_interface)))
 
     # Submit to local UNL ES instance
+    es_sinks = []
     if args.feed_es:
-        submit_to_elastic(processed_data, index_name='wmamon-dummy', args=args)
-        submit_to_elastic(site_data, index_name='wmamon-dummy-sites', doc_type='site_info', args=args)
-        submit_to_elastic(prio_data, index_name='wmamon-dummy-priorities', doc_type='priority_info', args=args)
-        submit_to_elastic(work_data, index_name='wmamon-dummy-work', doc_type='work_info', args=args)
+        es_sinks = [
+            ('ES agent info', partial(submit_to_elastic, processed_data, index_name=args.index_prefix,
+                                      args=args)),
+            ('ES site info', partial(submit_to_elastic, site_data, index_name=args.index_prefix + '-sites',
+                                     doc_type='site_info', args=args)),
+            ('ES prio info', partial(submit_to_elastic, prio_data, index_name=args.index_prefix + '-priorities',
+                                     doc_type='priority_info', args=args)),
+            ('ES work info', partial(submit_to_elastic, work_data, index_name=args.index_prefix + '-work',
+                                     doc_type='work_info', args=args)),
+        ]
+        if rollup_data:
+            es_sinks.append(('ES site rollup', partial(submit_to_elastic, rollup_data,
+                                                       index_name=args.index_prefix + '-site-rollup',
+                                                       doc_type='site_rollup', args=args)))
+
+    # The connection is closed by main, after the selfmon doc
+    try:
+        results = run_sinks(amq_sinks + es_sinks, workers=args.workers)
+    finally:
+        if args.delta:
+            flush_delta_cache()
+
+    logging.warning("Summary of CERN AMQ injection:")
+    for name, _ in amq_sinks:
+        sent, error = results[name]
+        if error is not None:
+            logging.error("  Submission of %s failed: %s", name, error)
+        else:
+            logging.warning("  Documents submitted for %s: %d", name, len(sent))
+
+    for name, _ in es_sinks:
+        res, error = results[name]
+        if error is not None:
+            logging.error("  Submission of %s failed: %s", name, error)
 
+    if all(error is None for _, error in results.values()):
+        save_fetched_etags()
     return 0
 
-if __name__ == '__main__':
+_shutdown = threading.Event()
+def request_shutdown(signum, frame):
+    logging.warning("Received signal %d, shutting down after the current cycle", signum)
+    _shutdown.set()
+
+def run_daemon(args):
+    """
+    Run main every args.interval seconds until SIGTERM/SIGINT, keeping
+    the cache and the cmsweb, AMQ and ES connections alive in between.
+    Cycles are scheduled on a fixed grid from the start time, so they
+    don't drift; slots missed by an overrunning cycle are skipped.
+    """
+    signal.signal(signal.SIGTERM, request_shutdown)
+    signal.signal(signal.SIGINT, request_shutdown)
+
+    start = time.time()
+    cycle = 0
+    try:
+        while not _shutdown.is_set():
+            try:
+                main(args)
+            except Exception:
+                logging.exception("Error in cycle %d", cycle)
+
+            cycle = int((time.time() - start) // args.interval) + 1
+            _shutdown.wait(max(0, start + cycle * args.interval - time.time()))
+    finally:
+        close_stomp_interface()
+        close_cmsweb_connection()
+        flush_cache()
+    return 0
+
+def make_parser():
     parser = ArgumentParser()
     parser.add_argument("--local_file", dest='local_file', default='',
                         help="Inject this local file")
+    parser.add_argument("--stream", action='store_true',
+                        dest="stream",
+                        help="Parse and process the agentInfo rows one at a time")
+    parser.add_argument("--wmstats", default=[], action='append',
+                        dest="wmstats",
+                        help="WMStats database URL to collect from, can be given several "
+                             "times to merge several instances [default: %s]" % DEFAULT_WMSTATS)
+    parser.add_argument("--fetch_timeout", default=120,
+                        type=int, dest="fetch_timeout",
+                        help="Seconds to wait for each WMStats instance [default: %(default)s]")
+    parser.add_argument("--processes", default=1,
+                        type=int, dest="processes",
+                        help="Split the rows over this many worker processes (at most one per "
+                             "CPU), not used with --stream [default: %(default)s]")
+    parser.add_argument("--parallel_min_rows", default=100,
+                        type=int, dest="parallel_min_rows",
+                        help="Process fewer rows than this serially even with --processes "
+                             "[default: %(default)s]")
+    parser.add_argument("--incremental", action='store_true', default=False,
+                        dest="incremental",
+                        help="Skip the run if the view did not change since the last one "
+                             "(ETag), and only process agents with a newer timestamp")
     parser.add_argument("--recreate", action='store_true',
                         dest="recreate_index",
                         help="Recreate the index")
     parser.add_argument("--feed_es", action='store_true',
                         dest="feed_es",
                         help="Feed also to the local ES instance")
+    parser.add_argument("--es_dedup", default='id',
+                        choices=['id', 'msearch', 'search'], dest="es_dedup",
+                        help="How to skip docs already in ES: deterministic ids, "
+                             "batched msearch or one search per doc [default: %(default)s]")
+    parser.add_argument("--es_pool_size", default=10,
+                        type=int, dest="es_pool_size",
+                        help="Maximum number of kept-alive connections to the ES host, "
+                             "shared by all doc types [default: %(default)s]")
+    parser.add_argument("--es_no_keep_alive", action='store_false', default=True,
+                        dest="es_keep_alive",
+                        help="Close the ES connection after each request instead of "
+                             "keeping it alive for the next one")
+    parser.add_argument("--es_timeout", default=30,
+                        type=int, dest="es_timeout",
+                        help="Timeout for ES requests in seconds [default: %(default)s]")
+    parser.add_argument("--es_threads", default=1,
+                        type=int, dest="es_threads",
+                        help="Number of threads for bulk injection to ES [default: %(default)s]")
+    parser.add_argument("--es_chunk_size", default=1000,
+                        type=int, dest="es_chunk_size",
+                        help="Maximum number of docs per ES bulk request [default: %(default)s]")
+    parser.add_argument("--es_chunk_bytes", default=10*1024*1024,
+                        type=int, dest="es_chunk_bytes",
+                        help="Maximum size of an ES bulk request [default: %(default)s]")
+    parser.add_argument("--es_max_retries", default=3,
+                        type=int, dest="es_max_retries",
+                        help="Retries of docs rejected by ES with 429/503 [default: %(default)s]")
     parser.add_argument("-i", "--index_prefix", default="wmamon-dummy",
                         type=str, dest="index_prefix",
                         help="Index prefix to use [default: %(default)s]")
+    parser.add_argument("--index_period", default=None,
+                        choices=['daily', 'weekly'], dest="index_period",
+                        help="Write to daily or weekly indices <prefix>-<date>, based on the "
+                             "doc timestamp, instead of a single index per doc type [default: single index]")
+    parser.add_argument("--index_retention", default=0,
+                        type=int, dest="index_retention",
+                        help="With --index_period, delete indices older than this many days "
+                             "(0: keep all) [default: %(default)s]")
     parser.add_argument("--log_dir", default='log/',
                         type=str, dest="log_dir",
                         help="Directory for logging information [default: %(default)s]")
@@ -365,12 +1262,106 @@ if __name__ == '__main__':
     parser.add_argument("--password", default='password',
                         type=str, dest="password",
                         help="Plaintext password or file containing it [default: %(default)s]")
+    parser.add_argument("--amq_host", default='dashb-mb.cern.ch:61113',
+                        type=str, dest="amq_host",
+                        help="CERN AMQ broker host:port [default: %(default)s]")
+    parser.add_argument("--es_host", default='localhost:9200',
+                        type=str, dest="es_host",
+                        help="Elasticsearch host:port [default: %(default)s]")
+    parser.add_argument("--amq_receipts", action='store_true', default=False,
+                        dest="amq_receipts",
+                        help="Only count notifications confirmed by a broker receipt as sent")
+    parser.add_argument("--amq_window", default=100,
+                        type=int, dest="amq_window",
+                        help="Maximum number of unconfirmed notifications in flight "
+                             "with --amq_receipts [default: %(default)s]")
+    parser.add_argument("--amq_batch_size", default=1,
+                        type=int, dest="amq_batch_size",
+                        help="Maximum number of docs packed into one AMQ message "
+                             "as a JSON array [default: %(default)s]")
+    parser.add_argument("--amq_batch_bytes", default=256*1024,
+                        type=int, dest="amq_batch_bytes",
+                        help="Maximum size of a packed AMQ message body [default: %(default)s]")
+    parser.add_argument("--amq_max_rate", default=0,
+                        type=float, dest="amq_max_rate",
+                        help="Maximum number of AMQ messages sent per second, lowered "
+                             "while the broker reports errors or is slow (0: no limit) "
+                             "[default: %(default)s]")
+    parser.add_argument("--amq_max_bytes_rate", default=0,
+                        type=float, dest="amq_max_bytes_rate",
+                        help="Maximum AMQ message body bytes sent per second, lowered "
+                             "like --amq_max_rate (0: no limit) [default: %(default)s]")
+    parser.add_argument("--amq_target_latency", default=0.5,
+                        type=float, dest="amq_target_latency",
+                        help="With a rate limit, slow down when the average send latency "
+                             "(receipt round trip with --amq_receipts) is above this "
+                             "many seconds [default: %(default)s]")
+    parser.add_argument("--amq_heartbeat", default=0,
+                        type=int, dest="amq_heartbeat",
+                        help="STOMP heartbeat interval in ms, heartbeat timeouts also "
+                             "lower the rate limit (0: no heartbeats) [default: %(default)s]")
+    parser.add_argument("--spool_dir", default='~/wmamon_es/spool',
+                        type=str, dest="spool_dir",
+                        help="Keep notifications that failed to send here, to send them "
+                             "on the next connection ('' to drop them) [default: %(default)s]")
+    parser.add_argument("--spool_max_mb", default=100,
+                        type=int, dest="spool_max_mb",
+                        help="Maximum compressed size of the spool in MB, the oldest "
+                             "notifications are dropped beyond it [default: %(default)s]")
+    parser.add_argument("--spool_max_age", default=24,
+                        type=int, dest="spool_max_age",
+                        help="Drop spooled notifications older than this many hours "
+                             "[default: %(default)s]")
+    parser.add_argument("--site_rollup", action='store_true', default=False, dest="site_rollup",
+                        help="Also send per-site totals over all agents, as "
+                             "cms_wmagent_info_site_rollup docs (and to ES with --feed_es)")
+    parser.add_argument("--state_backend", default='json',
+                        choices=['json', 'sqlite'], dest="state_backend",
+                        help="How to store the cache of processed docs [default: %(default)s]")
+    parser.add_argument("--cache_file", default=None,
+                        type=str, dest="cache_file",
+                        help="Cache file [default: %s for json, %s for sqlite]" % (
+                            DEFAULT_CACHE_FILES['json'], DEFAULT_CACHE_FILES['sqlite']))
+    parser.add_argument("--delta", action='store_true', default=False, dest="delta",
+                        help="Only send site/prio/work docs whose content changed since last sent")
+    parser.add_argument("--full_refresh", default=60,
+                        type=int, dest="full_refresh",
+                        help="With --delta, resend unchanged docs after this many minutes "
+                             "(0: never) [default: %(default)s]")
+    parser.add_argument("--workers", default=4,
+                        type=int, dest="workers",
+                        help="Number of AMQ/ES submissions to run concurrently [default: %(default)s]")
+    parser.add_argument("--daemon", action='store_true', default=False, dest="daemon",
+                        help="Keep running, one cycle every --interval seconds")
+    parser.add_argument("--interval", default=300,
+                        type=int, dest="interval",
+                        help="Seconds between cycles in daemon mode [default: %(default)s]")
+    parser.add_argument("--metrics_file", default='',
+                        type=str, dest="metrics_file",
+                        help="Write per-stage timings, doc and byte counts of each cycle "
+                             "to this file [default: none]")
+    parser.add_argument("--metrics_format", default='json',
+                        choices=['json', 'prometheus'], dest="metrics_format",
+                        help="Format of --metrics_file, 'prometheus' for the "
+                             "node_exporter textfile collector [default: %(default)s]")
+    parser.add_argument("--selfmon", action='store_true', default=False, dest="selfmon",
+                        help="Also send the stage metrics as a cms_wmagent_info_selfmon doc")
+    parser.add_argument("--profile", default=0.,
+                        type=float, dest="profile",
+                        help="Fraction of runs to profile with cProfile (and tracemalloc, if "
+                             "available), writing the reports to --log_dir [default: never]")
     parser.add_argument("--dry_run", action='store_true', default=False, dest="dry_run",
                         help="Create all the monitoring information but don't inject anything")
     parser.add_argument("--email_alerts", default=[], action='append',
                         dest="email_alerts",
                         help="Email addresses for alerts [default: none]")
+    return parser
+
+if __name__ == '__main__':
+    parser = make_parser()
     args = parser.parse_args()
     set_up_logging(args)
 
+    if args.daemon:
+        sys.exit(run_daemon(args))
     sys.exit(main(args))